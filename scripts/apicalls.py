@@ -1,13 +1,209 @@
+import argparse
 import json
+import logging
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 
+from scripts.registry import register
 from scripts.scoring import prepare_data
+from scripts.utils import configure_logging
+
+logger = logging.getLogger(__name__)
 
 URL = "http://127.0.0.1:8000/"
+ENDPOINTS = ['predict', 'score', 'summarise', 'diagnose']
+
+
+def make_session(pool_size: int = 10) -> requests.Session:
+    """
+    Session that keeps up to pool_size connections to the API alive and reuses them between requests
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def wait_for_job(
+        response: requests.Response,
+        interval: float = 1.0,
+        session: requests.Session = None,
+        timeout: float = 600
+) -> requests.Response:
+    """
+    Polls a job returned by the API until it is no longer pending or running
+    :param response: Response returned when the job was submitted
+    :param interval: Seconds between polls
+    :param session: Session to poll with. Default is a new connection per poll
+    :param timeout: Seconds to wait for the job, so that a job that never finishes does not block the caller
+    :return: Response for the finished or failed job
+    :raises TimeoutError: If the job is still pending or running after timeout seconds
+    """
+    deadline = time.monotonic() + timeout
+    while response.status_code == 202:
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Job {response.json()['job_id']} has not finished after {timeout}s")
+        time.sleep(interval)
+        response = (session or requests).get(URL + response.json()['location'].lstrip('/'))
+    return response
+
+
+def make_predict_payloads(X: pd.DataFrame, n_rows: int) -> list:
+    """
+    Splits test data into /predict payloads of n_rows rows in the columnar layout accepted by the API
+    """
+    return [
+        json.dumps({'columns': {column: X[column].iloc[start:start + n_rows].tolist() for column in X.columns}})
+        for start in range(0, X.shape[0], n_rows)
+    ]
+
+
+def send_request(session: requests.Session, endpoint: str, payload: str = None) -> int:
+    """
+    :return: Status code. /diagnose only submits a job, so it is not polled
+    """
+    if endpoint == 'predict':
+        response = session.post(URL + endpoint, payload, headers={'Content-Type': 'application/json'})
+    else:
+        response = session.get(URL + endpoint)
+    return response.status_code
+
+
+def summarise_latencies(records: list, elapsed: float) -> dict:
+    """
+    :param records: [(endpoint, latency in seconds, succeeded)] of every request
+    :param elapsed: Duration of the load test in seconds
+    :return: Throughput, error rate and latency percentiles per endpoint
+    """
+    summary = {}
+    for endpoint in dict.fromkeys(endpoint for endpoint, _, _ in records):
+        latencies = np.array([latency for e, latency, _ in records if e == endpoint])
+        n_errors = sum(not succeeded for e, _, succeeded in records if e == endpoint)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        summary[endpoint] = {
+            'requests': int(latencies.size),
+            'errors': n_errors,
+            'error_rate': n_errors / latencies.size,
+            'throughput': latencies.size / elapsed,
+            'mean_latency': float(latencies.mean()),
+            'p50_latency': float(p50),
+            'p95_latency': float(p95),
+            'p99_latency': float(p99)
+        }
+    return summary
+
+
+def load_test(
+        payloads: list,
+        endpoints: list = None,
+        n_requests: int = 100,
+        concurrency: int = 10,
+        rate: float = None
+) -> dict:
+    """
+    Sends n_requests requests to every endpoint from concurrency threads sharing a pool of keep-alive connections.
+    Requests to the endpoints are interleaved and /predict cycles through payloads.
+
+    Without rate, every thread sends its next request as soon as the last one has returned.
+    With rate, requests are started at rate requests per second in total. Latency is then measured from the time
+    a request was due, so requests delayed because every thread was busy count as slow instead of being left out.
+
+    :param payloads: /predict payloads
+    :param endpoints: Endpoints to be tested. Default is all endpoints
+    :param n_requests: Requests per endpoint
+    :param concurrency: Number of requests in flight at once
+    :param rate: Target requests per second across all endpoints
+    :return: {'concurrency': ..., 'rate': ..., 'elapsed': <seconds>, 'endpoints': <summary per endpoint>}
+    """
+    endpoints = endpoints or ENDPOINTS
+    schedule = [
+        (endpoint, payloads[i % len(payloads)] if endpoint == 'predict' else None)
+        for i in range(n_requests) for endpoint in endpoints
+    ]
+    session = make_session(pool_size=concurrency)
+    records = []
+    records_lock = threading.Lock()
+    start_time = time.perf_counter()
+
+    def run(i: int) -> None:
+        endpoint, payload = schedule[i]
+        if rate:
+            due = start_time + i / rate
+            time.sleep(max(due - time.perf_counter(), 0))
+        else:
+            due = time.perf_counter()
+        try:
+            succeeded = send_request(session, endpoint, payload) < 400
+        except requests.RequestException:
+            succeeded = False
+        latency = time.perf_counter() - due
+        with records_lock:
+            records.append((endpoint, latency, succeeded))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run, range(len(schedule))))
+    elapsed = time.perf_counter() - start_time
+    session.close()
+
+    return {
+        'concurrency': concurrency,
+        'rate': rate,
+        'elapsed': elapsed,
+        'endpoints': summarise_latencies(records, elapsed)
+    }
+
+
+def format_load_test(result: dict) -> str:
+    rows = [('Endpoint', 'Requests', 'Errors', 'Req/s', 'p50 ms', 'p95 ms', 'p99 ms')]
+    for endpoint, s in result['endpoints'].items():
+        rows.append((
+            f'/{endpoint}', str(s['requests']), f"{s['errors']} ({s['error_rate']:.1%})", f"{s['throughput']:.1f}",
+            *(f"{s[p] * 1000:.1f}" for p in ('p50_latency', 'p95_latency', 'p99_latency'))
+        ))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return '\n'.join(' '.join(v.ljust(w) for v, w in zip(row, widths)).rstrip() for row in rows) + '\n'
+
+
+def run_load_test(
+        endpoints: list = None,
+        n_requests: int = 100,
+        concurrency: int = 10,
+        rate: float = None,
+        predict_rows: int = 100
+) -> dict:
+    """
+    Load tests the API with payloads made from the test data and writes the results to
+    loadtest_<timestamp>.txt in output_model_path. See load_test
+    """
+    with open('config.json', 'r') as f:
+        config = json.load(f)
+
+    test_data_path = config['test_data_path']
+    model_path = config['output_model_path']
+
+    data = prepare_data(test_data_path, dropped_columns=["corporation"])
+    payloads = make_predict_payloads(data['test']['X'], predict_rows)
+
+    logger.info("Sending %s requests per endpoint with concurrency %s%s",
+                n_requests, concurrency, f" at {rate} requests/s" if rate else "")
+    result = load_test(payloads, endpoints, n_requests=n_requests, concurrency=concurrency, rate=rate)
+    result['predict_rows'] = predict_rows
+    logger.info(format_load_test(result))
+
+    output_file = os.path.join(model_path, f'loadtest_{time.strftime("%y%m%d%H%M%S")}.txt')
+    with open(output_file, 'w') as f:
+        logger.info('Writing load test results to %s', output_file)
+        f.write(json.dumps(result, indent=4))
+    register(output_file)
+    return result
 
 
 def main():
@@ -19,21 +215,24 @@ def main():
 
     data = prepare_data(test_data_path, dropped_columns=["corporation"])
     input_data = data['test']['X'].to_json(orient='table', index=False)
-    print(pd.DataFrame(json.loads(input_data)['data']))
+    logger.info(pd.DataFrame(json.loads(input_data)['data']))
 
     headers = {'Content-Type': 'application/json'}
 
-    predictions = requests.post(URL + 'predict', input_data, headers=headers)
-    print(predictions.json())
+    with make_session() as session:
+        predictions = session.post(URL + 'predict', input_data, headers=headers)
+        logger.info(predictions.json())
 
-    score = requests.get(URL + 'score')
-    print(score.json())
+        score = session.get(URL + 'score')
+        logger.info(score.json())
 
-    summary = requests.get(URL + 'summarise')
-    print(summary.json())
+        summary = session.get(URL + 'summarise')
+        logger.info(summary.json())
 
-    diagnosis = requests.get(URL + 'diagnose')
-    print(diagnosis.json())
+        diagnosis = wait_for_job(
+            session.get(URL + 'diagnose'), session=session, timeout=config.get('diagnose_timeout', 600)
+        )
+        logger.info(diagnosis.json())
 
     response = {
         'predictions': predictions.json(),
@@ -44,9 +243,31 @@ def main():
 
     output_file = os.path.join(model_path, f'apireturns_{time.strftime("%y%m%d%H%M%S")}.txt')
     with open(output_file, 'w') as f:
-        print(f'Writing API responses to {output_file}')
+        logger.info('Writing API responses to %s', output_file)
         f.write(json.dumps(response, indent=4))
+    register(output_file)
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Calls the API once or load tests it")
+    parser.add_argument('--load-test', action='store_true', help="Load test the API instead of calling it once")
+    parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=ENDPOINTS)
+    parser.add_argument('--requests', type=int, default=100, help="Requests per endpoint")
+    parser.add_argument('--concurrency', type=int, default=10, help="Requests in flight at once")
+    parser.add_argument('--rate', type=float, default=None, help="Target requests per second")
+    parser.add_argument('--predict-rows', type=int, default=100, help="Rows per /predict request")
+    parser.add_argument('--url', default=URL)
+    args = parser.parse_args()
+
+    URL = args.url.rstrip('/') + '/'
+    configure_logging()
+    if args.load_test:
+        run_load_test(
+            endpoints=args.endpoints,
+            n_requests=args.requests,
+            concurrency=args.concurrency,
+            rate=args.rate,
+            predict_rows=args.predict_rows
+        )
+    else:
+        main()
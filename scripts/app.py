@@ -1,74 +1,219 @@
+import glob
 import json
 import os
+import time
 
-import pandas as pd
 from dotenv import load_dotenv
+from flask import Blueprint
+from flask import current_app
 from flask import Flask
+from flask import g
 from flask import jsonify
 from flask import request
 
 import scripts.scoring as scorer
-from scripts.diagnostics import check_execution_time
-from scripts.diagnostics import check_missing_values
+from scripts.cache import content_fingerprint
+from scripts.cache import ResultCache
+from scripts.datastore import get_latest_dataset
 from scripts.diagnostics import dataframe_summary
-from scripts.diagnostics import get_outdated_packages_list
-from scripts.diagnostics import model_predictions
+from scripts.diagnostics import run_diagnostics
+from scripts.inference import MicroBatcher
+from scripts.inference import ModelWatcher
+from scripts.inference import payload_to_array
+from scripts.inference import predict_array
+from scripts.jobs import FAILED
+from scripts.jobs import FINISHED
+from scripts.jobs import JobManager
+from scripts.metrics import CONTENT_TYPE
+from scripts.metrics import RequestMetrics
+from scripts.metrics import UNMATCHED
+from scripts.summary import load_stats
 from scripts.training import prepare_dataset
-from scripts.utils import load_model
+from scripts.utils import configure_logging
+from scripts.utils import get_latest_file
 
 load_dotenv(verbose=True)
 
-app = Flask(__name__)
-app.secret_key = os.getenv("SECRET_KEY")
-
-
-@app.route("/predict", methods=['POST', 'OPTIONS'])
+api = Blueprint('api', __name__)
+
+
+class ServingState:
+    """
+    Everything the API serves from: the deployed model, the training data and cached results.
+    It is created once by create_app, so worker processes forked from the server share it copy-on-write.
+    Its metrics are in shared memory, so they count the requests of every worker.
+    """
+    def __init__(self, config: dict, endpoints: list = ()):
+        self.config = config
+        self.dataset_csv_path = config['output_folder_path']
+        self.deployment_path = config['prod_deployment_path']
+        self.model_dir = config['output_model_path']
+        self.test_data_path = config['test_data_path']
+
+        self.metrics = RequestMetrics(endpoints)
+        self.results = ResultCache()
+        self.diagnostic_jobs = JobManager(
+            max_workers=1,
+            ttl=config.get('diagnostics_cache_ttl', 600),
+            store_dir=config.get('job_store_path')
+        )
+        self.model_watcher = ModelWatcher(
+            self.deployment_path, interval=config.get('model_reload_interval', 5)
+        )
+        self.batcher = MicroBatcher(
+            window=config.get('predict_batch_window_ms', 2) / 1000,
+            max_batch_size=config.get('predict_max_batch_size', 1024)
+        ) if config.get('predict_batching', False) else None
+        self.get_data()
+
+    def start_background_tasks(self) -> None:
+        """
+        Starts the threads the state needs. Threads do not survive a fork,
+        so this is called in every process that serves requests.
+        """
+        self.model_watcher.start()
+        if self.batcher is not None:
+            self.batcher.start()
+
+    def get_data(self) -> tuple:
+        """
+        Latest training data and the summary statistics stored with it, reloaded when the dataset changes
+        :return: Fingerprint of the dataset, DataFrame, DatasetStats or None
+        """
+        latest_dataset = get_latest_dataset(self.dataset_csv_path)
+        key = content_fingerprint(latest_dataset)
+        data = self.results.get_or_compute(
+            'data',
+            key,
+            prepare_dataset,
+            self.dataset_csv_path,
+            dropped_columns=['corporation'],
+            create_val_data=False
+        )
+        stats = self.results.get_or_compute('stats', key, load_stats, latest_dataset, compute=False)
+        return key, data, stats
+
+
+def get_state() -> ServingState:
+    return current_app.extensions['adras']
+
+
+@api.route("/predict", methods=['POST', 'OPTIONS'])
 def predict():
-    data_json = request.get_json()
-    df = pd.DataFrame(data_json['data'])
-    print(df)
-    predictions = model_predictions(df, model=prediction_model)
-    print(predictions)
-    return jsonify(predictions=predictions), 200
-
-
-@app.route("/score", methods=['GET', 'OPTIONS'])
+    state = get_state()
+    prediction_model, feature_names = state.model_watcher.current
+    try:
+        X = payload_to_array(request.get_json(), feature_names)
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify(error=f"Invalid payload: {e}"), 400
+    start = time.perf_counter()
+    if state.batcher is not None:
+        predictions = state.batcher.predict(prediction_model, X)
+    else:
+        predictions = predict_array(prediction_model, X)
+    state.metrics.observe_inference(time.perf_counter() - start, len(X))
+    return jsonify(predictions=predictions.astype(float).tolist()), 200
+
+
+@api.route("/score", methods=['GET', 'OPTIONS'])
 def score():
-    return jsonify(score=scorer.main()), 200
+    state = get_state()
+    model_file = get_latest_file(state.model_dir, 'trainedmodel_*.pkl')
+    key = content_fingerprint(
+        model_file,
+        os.path.splitext(model_file)[0] + '.npz',
+        *sorted(glob.glob(f'{state.test_data_path}/*.csv'))
+    )
+    return jsonify(score=state.results.get_or_compute('score', key, scorer.main)), 200
 
 
-@app.route("/summarise", methods=['GET', 'OPTIONS'])
+@api.route("/summarise", methods=['GET', 'OPTIONS'])
 def stats():
-    return jsonify(summary=dataframe_summary(data)), 200
+    state = get_state()
+    key, data, stats = state.get_data()
+    summary = state.results.get_or_compute('summary', key, dataframe_summary, data, stats=stats)
+    return jsonify(summary=summary), 200
 
 
-@app.route("/diagnose", methods=['GET', 'OPTIONS'])
+def job_response(job: dict):
+    if job['status'] == FINISHED:
+        return jsonify(job_id=job['job_id'], status=job['status'], **job['result']), 200
+    if job['status'] == FAILED:
+        return jsonify(job_id=job['job_id'], status=job['status'], error=job['error']), 500
+    return jsonify(
+        job_id=job['job_id'], status=job['status'], location=f"/diagnose/{job['job_id']}"
+    ), 202
+
+
+@api.route("/diagnose", methods=['GET', 'OPTIONS'])
 def diagnose():
-    missing_values = check_missing_values(data)
-    execution_time = check_execution_time(
-        training_script_output_dir=model_dir, ingestion_script_output_dir=dataset_csv_path
+    state = get_state()
+    _, data, stats = state.get_data()
+    job = state.diagnostic_jobs.submit(
+        'diagnose',
+        run_diagnostics,
+        data,
+        state.config,
+        stats=stats
     )
-    outdated_dependencies = get_outdated_packages_list(deployment_path)
-    return jsonify(
-        missing_values=missing_values,
-        execution_time=execution_time,
-        outdated_dependencies=outdated_dependencies
-    ), 200
+    return job_response(job)
 
 
-if __name__ == '__main__':
-    with open('config.json', 'r') as f:
-        config = json.load(f)
+@api.route("/diagnose/<job_id>", methods=['GET', 'OPTIONS'])
+def diagnose_result(job_id: str):
+    job = get_state().diagnostic_jobs.get(job_id)
+    if job is None:
+        return jsonify(error=f"Unknown job: {job_id}"), 404
+    return job_response(job)
 
-    dataset_csv_path = config['output_folder_path']
-    deployment_path = config['prod_deployment_path']
-    model_dir = config['output_model_path']
 
-    data = prepare_dataset(
-        dataset_csv_path,
-        dropped_columns=['corporation'],
-        create_val_data=False
-    )
-    prediction_model = load_model(deployment_path, is_deployed=True)
+@api.route("/metrics", methods=['GET'])
+def metrics():
+    """
+    Request counts, latencies and inference times of all workers in the Prometheus text format
+    """
+    return get_state().metrics.render(), 200, {'Content-Type': CONTENT_TYPE}
 
-    app.run(host='0.0.0.0', port=8000, debug=True, threaded=True, extra_files=['config.json'])
+
+def start_request_timer() -> None:
+    g.request_start = time.perf_counter()
+
+
+def record_request(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        # Requests are labelled by route, e.g. /diagnose/<job_id>, so that job ids do not make new series
+        endpoint = request.url_rule.rule if request.url_rule is not None else UNMATCHED
+        get_state().metrics.observe_request(endpoint, response.status_code, time.perf_counter() - start)
+    return response
+
+
+def create_app(config: dict = None, start_background_tasks: bool = True) -> Flask:
+    """
+    Creates the API and preloads the deployed model and the training data
+    :param config: Configuration. Default is read from config.json
+    :param start_background_tasks: Start reloading the model in the background.
+    Servers that fork workers start these in each worker instead. See scripts.serve
+    :return: Flask application
+    """
+    if config is None:
+        with open('config.json', 'r') as f:
+            config = json.load(f)
+
+    app = Flask(__name__)
+    app.secret_key = os.getenv("SECRET_KEY")
+    app.register_blueprint(api)
+    app.extensions['adras'] = ServingState(config, endpoints=sorted({rule.rule for rule in app.url_map.iter_rules()}))
+    app.before_request(start_request_timer)
+    app.after_request(record_request)
+
+    if start_background_tasks:
+        app.extensions['adras'].start_background_tasks()
+    return app
+
+
+if __name__ == '__main__':
+    # The reloader is disabled so that a new deployment does not restart the server.
+    # The model watcher picks up the new model instead.
+    configure_logging()
+    create_app().run(host='0.0.0.0', port=8000, debug=True, threaded=True, use_reloader=False)
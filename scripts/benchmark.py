@@ -0,0 +1,465 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import string
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from scripts.app import create_app
+from scripts.deployment import main as deploy
+from scripts.diagnostics import check_missing_values
+from scripts.diagnostics import dataframe_summary
+from scripts.diagnostics import get_outdated_packages_list
+from scripts.diagnostics import model_predictions
+from scripts.ingestion import main as ingest
+from scripts.reporting import main as report
+from scripts.scoring import main as score
+from scripts.scoring import prepare_data
+from scripts.training import main as train
+from scripts.training import prepare_dataset
+from scripts.utils import configure_logging
+
+COLUMNS = ['corporation', 'lastmonth_activity', 'lastyear_activity', 'number_of_employees', 'exited']
+STAGES = ['ingestion', 'training', 'scoring', 'deployment', 'reporting', 'diagnostics', 'api']
+ENDPOINTS = ['/predict', '/score', '/summarise']
+# Rows generated in memory at once. Larger files are written in several appends
+GENERATOR_CHUNKSIZE = 1_000_000
+# Entry points: (seconds their import may take, packages they must not import).
+# A cron tick that finds no new files only imports scripts.fullprocess
+HEAVY_PACKAGES = ['pandas', 'sklearn', 'matplotlib']
+IMPORT_BUDGETS = {
+    'scripts.fullprocess': (0.1, HEAVY_PACKAGES),
+    'scripts.registry': (0.05, HEAVY_PACKAGES),
+    'scripts.apicalls': (1.0, ['sklearn', 'matplotlib']),
+    'scripts.app': (1.0, ['sklearn', 'matplotlib']),
+    'scripts.serve': (1.0, ['sklearn', 'matplotlib']),
+    'scripts.ingestion': (1.0, ['sklearn', 'matplotlib']),
+    'scripts.training': (1.0, ['sklearn', 'matplotlib']),
+    'scripts.scoring': (1.0, ['sklearn', 'matplotlib']),
+    'scripts.reporting': (1.0, ['sklearn', 'matplotlib']),
+    'scripts.diagnostics': (1.0, ['sklearn', 'matplotlib']),
+}
+
+
+def generate_rows(n_rows: int, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Synthetic rows in the schema of sourcedata. Customers with little recent activity are more likely to exit.
+    A few rows are duplicated so that ingestion has duplicates to drop.
+    """
+    letters = np.array(list(string.ascii_lowercase))
+    corporation = [''.join(name) for name in letters[rng.integers(0, 26, size=(n_rows, 4))]]
+    lastmonth_activity = rng.poisson(60, n_rows)
+    lastyear_activity = lastmonth_activity * 12 + rng.poisson(200, n_rows)
+    number_of_employees = rng.integers(1, 1000, n_rows)
+    logit = 1.5 - lastmonth_activity / 30 + rng.normal(0, 1, n_rows)
+    exited = (rng.random(n_rows) < 1 / (1 + np.exp(-logit))).astype(np.int64)
+    df = pd.DataFrame({
+        'corporation': corporation,
+        'lastmonth_activity': lastmonth_activity,
+        'lastyear_activity': lastyear_activity,
+        'number_of_employees': number_of_employees,
+        'exited': exited
+    }, columns=COLUMNS)
+    n_duplicates = n_rows // 100
+    if n_duplicates:
+        df.iloc[-n_duplicates:] = df.iloc[:n_duplicates].to_numpy()
+    return df
+
+
+def generate_corpus(output_dir: str, n_rows: int, n_files: int = 1, seed: int = 0) -> list:
+    """
+    Writes a synthetic corpus of CSV files with the columns
+    corporation,lastmonth_activity,lastyear_activity,number_of_employees,exited
+
+    :param output_dir: Directory the files are written to
+    :param n_rows: Total number of rows
+    :param n_files: Number of files the rows are split across
+    :param seed: Seed of the random generator. The same seed produces the same corpus
+    :return: Paths of written files
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    rows_per_file = np.full(n_files, n_rows // n_files)
+    rows_per_file[:n_rows % n_files] += 1
+
+    paths = []
+    for i, file_rows in enumerate(rows_per_file):
+        path = os.path.join(output_dir, f'dataset{i + 1}.csv')
+        for start in range(0, max(int(file_rows), 1), GENERATOR_CHUNKSIZE):
+            chunk_rows = min(GENERATOR_CHUNKSIZE, int(file_rows) - start)
+            generate_rows(chunk_rows, rng).to_csv(path, mode='a' if start else 'w', header=not start, index=False)
+        paths.append(path)
+    return paths
+
+
+def prepare_workspace(workdir: str, config: dict, n_rows: int, n_files: int, n_test_rows: int, seed: int) -> dict:
+    """
+    Creates a workspace with its own config.json, a synthetic source corpus and synthetic test data
+    :return: Configuration of the workspace
+    """
+    os.makedirs(workdir, exist_ok=True)
+    config = dict(
+        config,
+        input_folder_path='sourcedata',
+        output_folder_path='ingesteddata',
+        test_data_path='testdata',
+        output_model_path='models',
+        prod_deployment_path='production_deployment',
+        environment_file=os.path.abspath(config.get('environment_file', 'environment.yml')),
+        job_store_path=None
+    )
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=4)
+
+    print(f"Generating {n_rows} rows in {n_files} files and {n_test_rows} test rows in {workdir}")
+    generate_corpus(os.path.join(workdir, config['input_folder_path']), n_rows, n_files, seed=seed)
+    generate_corpus(os.path.join(workdir, config['test_data_path']), n_test_rows, seed=seed + 1)
+    os.rename(
+        os.path.join(workdir, config['test_data_path'], 'dataset1.csv'),
+        os.path.join(workdir, config['test_data_path'], 'testdata.csv')
+    )
+    return config
+
+
+def measure(fn, *args, trace_memory: bool = True, **kwargs) -> tuple:
+    """
+    Runs fn once and measures its wall time and, with trace_memory, its peak Python heap usage.
+    Tracing memory slows down the measured code, so only compare results measured the same way.
+    :return: Result of fn, {'seconds': <float>, 'peak_memory_mb': <float or None>}
+    """
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = fn(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        peak_memory_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20 if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return result, {'seconds': seconds, 'peak_memory_mb': peak_memory_mb}
+
+
+def run_diagnostics_stage(config: dict) -> None:
+    """
+    Diagnostics without check_execution_time, which trains and ingests many times and is a benchmark itself
+    """
+    data = prepare_dataset(config['output_folder_path'], dropped_columns=['corporation'], create_val_data=False)
+    dataframe_summary(data)
+    check_missing_values(data)
+    model_predictions(data.drop('exited', axis=1), model_path=config['prod_deployment_path'])
+    get_outdated_packages_list(config['prod_deployment_path'])
+
+
+def benchmark_api(config: dict, n_requests: int, n_predict_rows: int, trace_memory: bool) -> dict:
+    """
+    Times the API in-process through Flask's test client, so results do not include network latency.
+    /score and /summarise are cached, so their first request is reported separately.
+    /diagnose runs check_execution_time and is not benchmarked.
+    """
+    results = {}
+    app, results['api startup'] = measure(
+        create_app, config, start_background_tasks=False, trace_memory=trace_memory
+    )
+    client = app.test_client()
+
+    X = prepare_data(config['test_data_path'], dropped_columns=['corporation'])['test']['X'].head(n_predict_rows)
+    payload = {'columns': {column: X[column].tolist() for column in X.columns}}
+    requests = {
+        '/predict': lambda: client.post('/predict', json=payload),
+        '/score': lambda: client.get('/score'),
+        '/summarise': lambda: client.get('/summarise')
+    }
+
+    def send_requests(endpoint: str, n: int) -> list:
+        latencies = []
+        for _ in range(n):
+            start = time.perf_counter()
+            response = requests[endpoint]()
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise Exception(f"{endpoint} returned {response.status_code}: {response.get_data(as_text=True)}")
+        return latencies
+
+    for endpoint in ENDPOINTS:
+        if endpoint != '/predict':
+            _, results[f'api {endpoint} first'] = measure(send_requests, endpoint, 1, trace_memory=trace_memory)
+        latencies, measurement = measure(send_requests, endpoint, n_requests, trace_memory=trace_memory)
+        results[f'api {endpoint}'] = {
+            'seconds': float(np.mean(latencies)),
+            'p95_seconds': float(np.percentile(latencies, 95)),
+            'peak_memory_mb': measurement['peak_memory_mb']
+        }
+    return results
+
+
+def run_benchmarks(
+        workdir: str,
+        n_rows: int,
+        n_files: int,
+        n_test_rows: int = None,
+        n_requests: int = 100,
+        n_predict_rows: int = 100,
+        stages: list = None,
+        trace_memory: bool = True,
+        seed: int = 0,
+        verbose: bool = False
+) -> dict:
+    """
+    Generates a synthetic corpus in workdir and runs every stage of the process on it in order.
+    Stages run with workdir as the working directory and their output is hidden unless verbose is set.
+
+    :param workdir: Empty directory the workspace is created in
+    :param n_rows: Number of rows in the source corpus
+    :param n_files: Number of files in the source corpus
+    :param n_test_rows: Number of test rows. Default is 10% of n_rows, at most 100000
+    :param n_requests: Number of requests sent to each API endpoint
+    :param n_predict_rows: Number of rows in each /predict request
+    :param stages: Stages to be measured. Unmeasured stages still run when later stages need their output
+    :param trace_memory: Measure peak memory. See measure
+    :param seed: Seed of the corpus generator
+    :param verbose: Show output of the stages
+    :return: Benchmark parameters, environment and results per stage
+    """
+    stages = stages or STAGES
+    n_test_rows = n_test_rows or max(min(n_rows // 10, 100_000), 1)
+    with open('config.json', 'r') as f:
+        config = prepare_workspace(workdir, json.load(f), n_rows, n_files, n_test_rows, seed)
+
+    steps = [
+        ('ingestion', ingest),
+        ('training', train),
+        ('scoring', score),
+        ('deployment', deploy),
+        ('reporting', report),
+        ('diagnostics', lambda: run_diagnostics_stage(config)),
+        ('api', lambda: benchmark_api(config, n_requests, n_predict_rows, trace_memory))
+    ]
+    last_stage = max(STAGES.index(stage) for stage in stages)
+
+    results = {}
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        for name, fn in steps[:last_stage + 1]:
+            print(f"Running {name}...")
+            with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+                if name == 'api':
+                    results.update(fn())
+                else:
+                    _, results[name] = measure(fn, trace_memory=trace_memory and name in stages)
+            if name not in stages:
+                results.pop(name, None)
+    finally:
+        os.chdir(cwd)
+
+    return {
+        'created_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'params': {
+            'n_rows': n_rows,
+            'n_files': n_files,
+            'n_test_rows': n_test_rows,
+            'n_requests': n_requests,
+            'n_predict_rows': n_predict_rows,
+            'trace_memory': trace_memory,
+            'seed': seed
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()
+        },
+        'results': results
+    }
+
+
+def measure_import(module: str, repeat: int = 3) -> dict:
+    """
+    Imports module in new interpreters started with -X importtime
+    :param module: Module to be imported
+    :param repeat: Number of imports. The fastest is reported
+    :return: {'seconds': <cumulative import time of module>, 'packages': [<top-level packages imported>]}
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    seconds = []
+    packages = set()
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+            cwd=root, capture_output=True, text=True, check=True
+        ).stderr
+        for line in output.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            _, cumulative, name = (field.strip() for field in line[len('import time:'):].split('|'))
+            if not cumulative.isdigit():
+                continue
+            packages.add(name.split('.')[0])
+            if name == module:
+                seconds.append(int(cumulative) / 1e6)
+    return {'seconds': min(seconds), 'packages': sorted(packages)}
+
+
+def check_import_budgets(budgets: dict = None, repeat: int = 3) -> list:
+    """
+    :param budgets: {<module>: (<seconds>, [<forbidden packages>])}. Default is IMPORT_BUDGETS
+    :param repeat: See measure_import
+    :return: [(module, seconds, budget, forbidden packages imported)] for every module. See format_import_times
+    """
+    results = []
+    for module, (budget, forbidden) in (budgets or IMPORT_BUDGETS).items():
+        measurement = measure_import(module, repeat=repeat)
+        imported = [package for package in forbidden if package in measurement['packages']]
+        results.append((module, measurement['seconds'], budget, imported))
+    return results
+
+
+def format_import_times(results: list) -> str:
+    rows = [('Module', 'Seconds', 'Budget', 'Forbidden imports')]
+    for module, seconds, budget, imported in results:
+        rows.append((module, f'{seconds:.4f}', f'{budget:.4f}', ', '.join(imported)))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return '\n'.join(' '.join(v.ljust(w) for v, w in zip(row, widths)).rstrip() for row in rows) + '\n'
+
+
+def compare_results(results: dict, baseline: dict, tolerance: float = 0.2, min_seconds: float = 0.01) -> list:
+    """
+    Flags stages that are slower or use more memory than in baseline
+    :param results: Results returned by run_benchmarks
+    :param baseline: Results saved earlier
+    :param tolerance: Allowed relative increase. 0.2 allows 20% more time or memory
+    :param min_seconds: Increases in time below this are ignored as noise
+    :return: [(stage, metric, baseline value, new value)] for every regression
+    """
+    if results['params'] != baseline['params']:
+        print(f"Warning: benchmark parameters differ from baseline {baseline['params']}")
+
+    regressions = []
+    for stage, measurement in results['results'].items():
+        if stage not in baseline['results']:
+            continue
+        for metric, value in measurement.items():
+            old_value = baseline['results'][stage].get(metric)
+            if value is None or old_value is None:
+                continue
+            if metric.endswith('seconds') and value - old_value < min_seconds:
+                continue
+            if value > old_value * (1 + tolerance):
+                regressions.append((stage, metric, old_value, value))
+    return regressions
+
+
+def format_results(results: dict, baseline: dict = None) -> str:
+    rows = [('Stage', 'Seconds', 'p95 seconds', 'Peak MB', 'Baseline seconds', 'Baseline peak MB')]
+
+    def fmt(value):
+        return '' if value is None else f'{value:.4f}'
+
+    for stage, m in results['results'].items():
+        old = (baseline or {}).get('results', {}).get(stage, {})
+        rows.append((
+            stage, fmt(m['seconds']), fmt(m.get('p95_seconds')), fmt(m['peak_memory_mb']),
+            fmt(old.get('seconds')), fmt(old.get('peak_memory_mb'))
+        ))
+    if baseline is None:
+        rows = [row[:4] for row in rows]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return '\n'.join(' '.join(v.ljust(w) for v, w in zip(row, widths)).rstrip() for row in rows) + '\n'
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Benchmarks every stage of the process on a synthetic corpus")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = subparsers.add_parser('generate', help="Write a synthetic corpus")
+    generate_parser.add_argument('output_dir')
+    generate_parser.add_argument('--rows', type=int, default=100_000)
+    generate_parser.add_argument('--files', type=int, default=1)
+    generate_parser.add_argument('--seed', type=int, default=0)
+
+    imports_parser = subparsers.add_parser('imports', help="Check import times of the entry points against budgets")
+    imports_parser.add_argument('--repeat', type=int, default=3, help="Imports per module. The fastest counts")
+
+    run_parser = subparsers.add_parser('run', help="Run the benchmarks")
+    run_parser.add_argument('--rows', type=int, default=100_000, help="Rows in the source corpus")
+    run_parser.add_argument('--files', type=int, default=10, help="Files in the source corpus")
+    run_parser.add_argument('--test-rows', type=int, default=None)
+    run_parser.add_argument('--requests', type=int, default=100, help="Requests per API endpoint")
+    run_parser.add_argument('--predict-rows', type=int, default=100, help="Rows per /predict request")
+    run_parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    run_parser.add_argument('--no-memory', action='store_true', help="Do not trace memory. Timings are more accurate")
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--workdir', default=None, help="Workspace directory. Default is benchmarks/<timestamp>")
+    run_parser.add_argument('--save', default=None, help="Save results as a baseline to this file")
+    run_parser.add_argument('--compare', default=None, help="Compare results to a saved baseline")
+    run_parser.add_argument('--tolerance', type=float, default=0.2)
+    run_parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+    configure_logging()
+
+    if args.command == 'generate':
+        paths = generate_corpus(args.output_dir, args.rows, args.files, seed=args.seed)
+        print(f"Wrote {args.rows} rows to {len(paths)} files in {args.output_dir}")
+        return
+
+    if args.command == 'imports':
+        results = check_import_budgets(repeat=args.repeat)
+        print(format_import_times(results))
+        over_budget = [result for result in results if result[1] > result[2] or result[3]]
+        for module, seconds, budget, imported in over_budget:
+            print(f"{module} is over budget: {seconds:.4f}s of {budget:.4f}s"
+                  + (f", imports {', '.join(imported)}" if imported else ""))
+        if over_budget:
+            sys.exit(1)
+        print("All imports are within budget")
+        return
+
+    workdir = args.workdir or os.path.join('benchmarks', time.strftime('%y%m%d%H%M%S'))
+    results = run_benchmarks(
+        workdir,
+        n_rows=args.rows,
+        n_files=args.files,
+        n_test_rows=args.test_rows,
+        n_requests=args.requests,
+        n_predict_rows=args.predict_rows,
+        stages=args.stages,
+        trace_memory=not args.no_memory,
+        seed=args.seed,
+        verbose=args.verbose
+    )
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    print(format_results(results, baseline))
+
+    results_file = os.path.join(workdir, 'benchmark.json')
+    with open(results_file, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f"Wrote results to {results_file}")
+    if args.save:
+        os.makedirs(os.path.dirname(args.save) or '.', exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(f"Saved baseline to {args.save}")
+
+    if baseline is not None:
+        regressions = compare_results(results, baseline, tolerance=args.tolerance)
+        for stage, metric, old_value, value in regressions:
+            print(f"Regression in {stage}: {metric} {old_value:.4f} -> {value:.4f}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions")
+
+
+if __name__ == '__main__':
+    main()
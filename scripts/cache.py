@@ -0,0 +1,92 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from scripts.fileindex import content_hash
+
+# Content hashes of files by path with the size and mtime_ns they were hashed at, so unchanged files
+# are not read again. A changed file replaces its entry, and the least recently used paths are evicted
+MAX_CONTENT_HASHES = 4096
+_content_hashes = OrderedDict()
+_content_hashes_lock = threading.Lock()
+
+
+def _iter_files(path: str):
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                yield os.path.join(root, name)
+    elif os.path.exists(path):
+        yield path
+
+
+def _cached_content_hash(path: str) -> str:
+    stat = os.stat(path)
+    version = (stat.st_size, stat.st_mtime_ns)
+    with _content_hashes_lock:
+        cached = _content_hashes.get(path)
+        if cached is not None and cached[0] == version:
+            _content_hashes.move_to_end(path)
+            return cached[1]
+
+    digest = content_hash(path)
+    with _content_hashes_lock:
+        _content_hashes[path] = (version, digest)
+        _content_hashes.move_to_end(path)
+        while len(_content_hashes) > MAX_CONTENT_HASHES:
+            _content_hashes.popitem(last=False)
+    return digest
+
+
+def content_fingerprint(*paths: str) -> str:
+    """
+    Fingerprint of the content of files and directories.
+    Files are only hashed again when their size or modification time changes.
+
+    :param paths: Files or directories. Paths that do not exist are part of the fingerprint as missing.
+    :return: Hex digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        digest.update(f'{path}\0'.encode())
+        for f in _iter_files(path or ''):
+            digest.update(f'{os.path.relpath(f, path)}:{_cached_content_hash(f)}\0'.encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Keeps the latest result computed for every name together with the fingerprint of its inputs.
+    A result is recomputed when it is requested with a different fingerprint.
+    """
+    def __init__(self):
+        self._results = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, name: str, key: str, fn, *args, **kwargs):
+        """
+        :param name: Name of result
+        :param key: Fingerprint of the inputs of fn
+        :param fn: Callable computing the result
+        :return: Cached result if it was computed with key else the result of fn(*args, **kwargs)
+        """
+        with self._lock:
+            lock = self._locks.setdefault(name, threading.Lock())
+
+        # Concurrent requests for the same result wait for one computation instead of repeating it
+        with lock:
+            cached = self._results.get(name)
+            if cached is not None and cached[0] == key:
+                return cached[1]
+            result = fn(*args, **kwargs)
+            self._results[name] = (key, result)
+            return result
+
+    def invalidate(self, name: str = None) -> None:
+        if name is None:
+            self._results.clear()
+        else:
+            self._results.pop(name, None)
@@ -0,0 +1,546 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from pandas.api.types import union_categoricals
+
+from scripts.registry import ARTIFACT_KINDS
+from scripts.registry import latest_artifact
+
+logger = logging.getLogger(__name__)
+
+COLUMNAR_EXTENSION = '.cols'
+# Rows per part that compact_columnar merges small parts of a columnar dataset into
+PART_ROWS = 100_000
+# Columnar copies of CSV files read with read_csv_cached
+CSV_CACHE_DIR = 'cache'
+DATASET_EXTENSIONS = {'csv': '.csv', 'columnar': COLUMNAR_EXTENSION}
+
+# Counts are float32 rather than int32 so that missing values can still be read and reported
+SCHEMA = {
+    'corporation': 'category',
+    'lastmonth_activity': 'float32',
+    'lastyear_activity': 'float32',
+    'number_of_employees': 'float32',
+    'exited': 'int8',
+}
+
+
+def is_columnar(path: str) -> bool:
+    return path.endswith(COLUMNAR_EXTENSION)
+
+
+def get_latest_dataset(dataset_dir: str, prefix: str = 'finaldata') -> str:
+    """
+    Returns the most recent dataset named '{prefix}_*' in any supported format.
+    Files should have datetime in their filename
+
+    :param dataset_dir: Directory containing datasets
+    :param prefix: Dataset name prefix
+    :return: Most lexicographically great dataset found or '' if there is none
+    """
+    if prefix in ARTIFACT_KINDS:
+        latest_dataset = latest_artifact(dataset_dir, prefix, tuple(DATASET_EXTENSIONS.values()))
+        if latest_dataset:
+            logger.debug("Latest dataset in the registry of %s is %s", dataset_dir, latest_dataset)
+            return latest_dataset
+
+    datasets = [
+        f for extension in DATASET_EXTENSIONS.values()
+        for f in glob.glob(os.path.join(dataset_dir, f'{prefix}_*{extension}'))
+    ]
+    datasets.sort(key=os.path.basename)
+    logger.debug("Searching for %s_* datasets in %s. Found %d datasets.", prefix, dataset_dir, len(datasets))
+    return datasets[-1] if datasets else ''
+
+
+def _selected_columns(all_columns: list, columns: list = None, dropped_columns: list = None) -> list:
+    selected = list(columns) if columns else list(all_columns)
+    return [c for c in selected if c not in (dropped_columns or [])]
+
+
+def apply_schema(df: DataFrame) -> DataFrame:
+    """
+    Casts the columns of df that are declared in SCHEMA to their declared dtypes
+
+    :param df: DataFrame to be cast
+    :return: DataFrame with compact dtypes
+    """
+    dtypes = {c: dtype for c, dtype in SCHEMA.items() if c in df.columns and df[c].dtype != dtype}
+    return df.astype(dtypes) if dtypes else df
+
+
+def concat_frames(frames: list) -> DataFrame:
+    """
+    Concatenates DataFrames read with SCHEMA.
+    Categorical columns are given the union of their categories first so they are not turned into objects.
+
+    :param frames: DataFrames to be concatenated
+    :return: DataFrame
+    """
+    frames = [f for f in frames if not f.empty] or frames[:1]
+    if len(frames) > 1:
+        for column in frames[0].columns:
+            if isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+                categories = union_categoricals([f[column] for f in frames]).categories
+                frames = [
+                    f.assign(**{column: f[column].cat.set_categories(categories)}) for f in frames
+                ]
+    return pd.concat(frames, ignore_index=True) if frames else DataFrame()
+
+
+def read_csv(
+        path: str,
+        columns: list = None,
+        dropped_columns: list = None,
+        chunksize: int = None,
+        start: int = 0,
+        stop: int = None
+):
+    """
+    Reads the selected columns of a CSV file with the dtypes declared in SCHEMA
+
+    :param path: Path to CSV file
+    :param columns: Columns to be read. Default is all columns.
+    :param dropped_columns: Columns not to be read
+    :param chunksize: If passed, an iterator of DataFrames with chunksize rows is returned
+    :param start: First row to be read
+    :param stop: Row before which reading stops. Default is the end of the file
+    :return: DataFrame
+    """
+    dropped_columns = dropped_columns or []
+    return pd.read_csv(
+        path,
+        usecols=lambda c: (not columns or c in columns) and c not in dropped_columns,
+        dtype=SCHEMA,
+        chunksize=chunksize,
+        skiprows=range(1, start + 1) if start else None,
+        nrows=stop - start if stop is not None else None
+    )
+
+
+def iter_csv_files(
+        paths: list,
+        columns: list = None,
+        dropped_columns: list = None,
+        chunksize: int = None,
+        n_workers: int = None
+):
+    """
+    Yields DataFrames read from many CSV files with the dtypes declared in SCHEMA, in the order of paths.
+    Files are read concurrently, n_workers files at a time. With chunksize, files are read one chunk at a time,
+    so memory use does not depend on file size: each open file has its next chunk read in the background.
+
+    :param paths: CSV files to be read
+    :param columns: Columns to be read. Default is all columns.
+    :param dropped_columns: Columns not to be read
+    :param chunksize: Number of rows per DataFrame
+    :param n_workers: Number of threads reading files. Default is ThreadPoolExecutor's default
+    :return: Generator of DataFrames
+    """
+    window = n_workers or min(32, (os.cpu_count() or 1) + 4)
+    if chunksize:
+        yield from _iter_csv_chunks(paths, columns, dropped_columns, chunksize, window)
+        return
+
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        for i in range(0, len(paths), window):
+            yield from executor.map(
+                lambda path: read_csv(path, columns=columns, dropped_columns=dropped_columns),
+                paths[i:i + window]
+            )
+
+
+def _iter_csv_chunks(paths: list, columns: list, dropped_columns: list, chunksize: int, window: int):
+    # Up to window files are open at a time. Chunks of the first one are yielded while the others read ahead
+    paths = iter(paths)
+    pending = deque()
+
+    def open_next(executor: ThreadPoolExecutor) -> None:
+        path = next(paths, None)
+        if path is not None:
+            reader = read_csv(path, columns=columns, dropped_columns=dropped_columns, chunksize=chunksize)
+            pending.append((reader, executor.submit(next, reader, None)))
+
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        try:
+            for _ in range(window):
+                open_next(executor)
+            while pending:
+                reader, future = pending[0]
+                chunk = future.result()
+                if chunk is None:
+                    pending.popleft()
+                    reader.close()
+                    open_next(executor)
+                    continue
+                # A reader is only read by one thread at a time: its next chunk is requested once this one is in
+                pending[0] = (reader, executor.submit(next, reader, None))
+                yield chunk
+        finally:
+            for reader, future in pending:
+                # A chunk that is being read is waited for, so the reader is not closed under it
+                if not future.cancel():
+                    future.exception()
+                reader.close()
+
+
+def read_csv_files(
+        paths: list,
+        columns: list = None,
+        dropped_columns: list = None,
+        cached: bool = False,
+        n_workers: int = None
+) -> DataFrame:
+    """
+    Reads many CSV files concurrently into a single DataFrame with the dtypes declared in SCHEMA
+
+    :param paths: CSV files to be read
+    :param columns: Columns to be read. Default is all columns.
+    :param dropped_columns: Columns not to be read
+    :param cached: Read files through their columnar copy. See read_csv_cached
+    :param n_workers: Number of threads reading files. Default is ThreadPoolExecutor's default
+    :return: DataFrame
+    """
+    reader = read_csv_cached if cached else read_csv
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        frames = list(executor.map(
+            lambda path: reader(path, columns=columns, dropped_columns=dropped_columns), paths
+        ))
+    return concat_frames(frames)
+
+
+def _part_rows(path: str, name: str, columns: list) -> int:
+    return int(np.load(os.path.join(path, name, f'{columns[0]}.npy'), mmap_mode='r').shape[0])
+
+
+def load_columnar_meta(path: str) -> dict:
+    """
+    :param path: Dataset directory ending in .cols
+    :return: {'columns': [<column>, ...], 'parts': [{'name': <directory>, 'rows': <rows>}, ...], 'next_part': <int>}
+    """
+    with open(os.path.join(path, 'columns.json'), 'r') as f:
+        meta = json.load(f)
+    # Datasets written before parts were listed only record their number
+    if isinstance(meta['parts'], int):
+        names = [f'part-{i:05d}' for i in range(meta['parts'])]
+        meta['parts'] = [{'name': name, 'rows': _part_rows(path, name, meta['columns'])} for name in names]
+        meta['next_part'] = len(names)
+    return meta
+
+
+def _save_columnar_meta(path: str, meta: dict) -> None:
+    # Readers see the old or the new list of parts, never a partly written one
+    meta_path = os.path.join(path, 'columns.json')
+    tmp_path = f'{meta_path}.tmp{os.getpid()}'
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+
+def _add_part(path: str, meta: dict, arrays: dict) -> dict:
+    name = f"part-{meta['next_part']:05d}"
+    meta['next_part'] += 1
+    os.makedirs(os.path.join(path, name), exist_ok=True)
+    for column, values in arrays.items():
+        np.save(os.path.join(path, name, f'{column}.npy'), values, allow_pickle=False)
+    return {'name': name, 'rows': len(next(iter(arrays.values()))) if arrays else 0}
+
+
+def write_columnar(df: DataFrame, path: str, append: bool = False) -> None:
+    """
+    Writes df to a columnar dataset directory. Each column is stored as a .npy file
+    so that it can be memory-mapped on read. Appending adds a new part to the dataset.
+
+    :param df: DataFrame to be written
+    :param path: Dataset directory ending in .cols
+    :param append: Add df to an existing dataset instead of replacing it
+    :return: None
+    """
+    if append and os.path.exists(os.path.join(path, 'columns.json')):
+        meta = load_columnar_meta(path)
+        df = df[meta['columns']]
+    else:
+        shutil.rmtree(path, ignore_errors=True)
+        meta = {'columns': list(df.columns), 'parts': [], 'next_part': 0}
+
+    arrays = {}
+    for column in df.columns:
+        values = df[column]
+        if values.dtype == object or isinstance(values.dtype, pd.CategoricalDtype):
+            # Missing strings are stored as '' the same way they are written to CSV
+            values = values.astype(object).where(values.notna(), '').to_numpy().astype(str)
+        else:
+            values = values.to_numpy()
+        arrays[column] = values
+
+    os.makedirs(path, exist_ok=True)
+    meta['parts'].append(_add_part(path, meta, arrays))
+    _save_columnar_meta(path, meta)
+
+
+def compact_columnar(path: str, target_rows: int = PART_ROWS) -> int:
+    """
+    Merges runs of consecutive parts that together hold at most target_rows rows into single parts,
+    so readers open a few large parts instead of many small ones. Parts that are large enough are not rewritten.
+    The new list of parts replaces the old one in a single rename before the merged parts are removed.
+
+    :param path: Dataset directory ending in .cols
+    :param target_rows: Largest number of rows in a merged part
+    :return: Number of parts that were merged
+    """
+    meta = load_columnar_meta(path)
+    groups = [[]]
+    for part in meta['parts']:
+        if groups[-1] and sum(p['rows'] for p in groups[-1]) + part['rows'] > target_rows:
+            groups.append([])
+        groups[-1].append(part)
+
+    parts = []
+    merged = []
+    for group in groups:
+        if len(group) <= 1:
+            parts.extend(group)
+            continue
+        arrays = {
+            column: np.concatenate([np.load(os.path.join(path, p['name'], f'{column}.npy')) for p in group])
+            for column in meta['columns']
+        }
+        parts.append(_add_part(path, meta, arrays))
+        merged.extend(p['name'] for p in group)
+
+    if merged:
+        logger.info("Merged %s parts of %s. It now has %s parts", len(merged), path, len(parts))
+        meta['parts'] = parts
+        _save_columnar_meta(path, meta)
+        for name in merged:
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+    return len(merged)
+
+
+def read_columnar(
+        path: str,
+        columns: list = None,
+        dropped_columns: list = None,
+        start: int = 0,
+        stop: int = None
+) -> DataFrame:
+    """
+    Reads the selected columns of a columnar dataset. Columns that are not selected are never read,
+    and only the parts holding rows in [start, stop) are opened.
+
+    :param path: Dataset directory ending in .cols
+    :param columns: Columns to be read. Default is all columns.
+    :param dropped_columns: Columns not to be read
+    :param start: First row to be read
+    :param stop: Row before which reading stops. Default is the end of the dataset
+    :return: DataFrame
+    """
+    try:
+        return _read_columnar(path, columns, dropped_columns, start, stop)
+    except FileNotFoundError:
+        # Parts were merged by compact_columnar after their list was read. The new list has the merged parts
+        return _read_columnar(path, columns, dropped_columns, start, stop)
+
+
+def _read_columnar(path: str, columns: list, dropped_columns: list, start: int, stop: int) -> DataFrame:
+    meta = load_columnar_meta(path)
+    data = {}
+    for column in _selected_columns(meta['columns'], columns, dropped_columns):
+        arrays = []
+        offset = 0
+        for part in meta['parts']:
+            first_row, offset = offset, offset + part['rows']
+            if offset <= start or (stop is not None and first_row >= stop):
+                continue
+            values = np.load(os.path.join(path, part['name'], f'{column}.npy'), mmap_mode='r')
+            arrays.append(values[max(start - first_row, 0):None if stop is None else stop - first_row])
+        if not arrays:
+            # No rows are selected. The first part still gives the column its dtype
+            arrays = [
+                np.load(os.path.join(path, part['name'], f'{column}.npy'), mmap_mode='r')[:0]
+                for part in meta['parts'][:1]
+            ] or [np.empty(0)]
+        values = np.concatenate(arrays) if len(arrays) > 1 else arrays[0]
+        if values.dtype.kind == 'U':
+            values = pd.Series(values, dtype=object).replace('', np.nan).to_numpy()
+        data[column] = values
+    return apply_schema(DataFrame(data))
+
+
+def read_dataset(
+        path: str,
+        columns: list = None,
+        dropped_columns: list = None,
+        start: int = 0,
+        stop: int = None
+) -> DataFrame:
+    """
+    Reads a CSV or columnar dataset, loading only the selected columns and rows.
+    Rows are appended to the end of a dataset, so [start, stop) can select the rows ingested in a run.
+
+    :param path: Path to dataset
+    :param columns: Columns to be read. Default is all columns.
+    :param dropped_columns: Columns not to be read
+    :param start: First row to be read
+    :param stop: Row before which reading stops. Default is the end of the dataset
+    :return: DataFrame
+    """
+    if is_columnar(path):
+        return read_columnar(path, columns=columns, dropped_columns=dropped_columns, start=start, stop=stop)
+
+    return read_csv(path, columns=columns, dropped_columns=dropped_columns, start=start, stop=stop)
+
+
+def write_dataset(df: DataFrame, path: str, append: bool = False) -> None:
+    """
+    Writes df to path in the format given by the path's extension.
+
+    :param df: DataFrame to be written
+    :param path: Path to dataset
+    :param append: Add df to an existing dataset instead of replacing it
+    :return: None
+    """
+    if is_columnar(path):
+        write_columnar(df, path, append=append)
+    elif append and os.path.exists(path):
+        columns = pd.read_csv(path, nrows=0).columns
+        df[columns].to_csv(path, mode='a', header=False, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+def _cache_key(*parts) -> str:
+    return hashlib.blake2b('\0'.join(map(str, parts)).encode(), digest_size=8).hexdigest()
+
+
+def read_csv_cached(
+        csv_path: str,
+        columns: list = None,
+        dropped_columns: list = None,
+        cache_dir: str = CSV_CACHE_DIR
+) -> DataFrame:
+    """
+    Reads a CSV file through a columnar copy kept in cache_dir.
+    Copies are named after the CSV's path, size and modification time, so a changed CSV gets a new copy and a copy
+    never changes once it is published. A copy is written to a directory of its own and renamed into place.
+    If another process published the same copy first, the rename fails and that copy is read instead.
+
+    :param csv_path: Path to CSV file
+    :param columns: Columns to be read. Default is all columns.
+    :param dropped_columns: Columns not to be read
+    :param cache_dir: Directory columnar copies are kept in
+    :return: DataFrame
+    """
+    stat = os.stat(csv_path)
+    prefix = f'{os.path.splitext(os.path.basename(csv_path))[0]}-{_cache_key(os.path.realpath(csv_path))}'
+    cache_path = os.path.join(cache_dir, f'{prefix}-{_cache_key(stat.st_size, stat.st_mtime_ns)}{COLUMNAR_EXTENSION}')
+    if not os.path.exists(os.path.join(cache_path, 'columns.json')):
+        logger.info("Caching %s in columnar format to %s", csv_path, cache_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix=f'.{prefix}.', dir=cache_dir)
+        write_columnar(read_csv(csv_path), tmp_path)
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.exists(os.path.join(cache_path, 'columns.json')):
+                raise
+        else:
+            # Copies of earlier versions of the CSV are not read again
+            for stale_path in glob.glob(os.path.join(cache_dir, f'{prefix}-*{COLUMNAR_EXTENSION}')):
+                if stale_path != cache_path:
+                    shutil.rmtree(stale_path, ignore_errors=True)
+    return read_columnar(cache_path, columns=columns, dropped_columns=dropped_columns)
+
+
+def sidecar_path(dataset_path: str, name: str) -> str:
+    """
+    Path of a file stored next to a dataset, e.g. finaldata_*.fingerprints.npy for finaldata_*.cols
+
+    :param dataset_path: Path to dataset
+    :param name: Name of sidecar file
+    :return: Path to sidecar file
+    """
+    return f'{os.path.splitext(dataset_path)[0]}.{name}'
+
+
+def row_fingerprints(df: DataFrame) -> np.ndarray:
+    """
+    64-bit hash of every row in df. Equal rows read with SCHEMA have equal fingerprints.
+
+    :param df: DataFrame to be hashed
+    :return: Array of uint64 fingerprints
+    """
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+
+class FingerprintSet:
+    """
+    Compact set of uint64 row fingerprints.
+    Fingerprints are kept in a few sorted runs which are merged as they grow,
+    so membership checks are binary searches and adding n fingerprints costs O(n log n) overall.
+    """
+    def __init__(self, fingerprints: np.ndarray = None):
+        self.runs = []
+        if fingerprints is not None and fingerprints.size:
+            self.runs.append(np.unique(fingerprints))
+
+    def __len__(self) -> int:
+        return sum(run.size for run in self.runs)
+
+    def contains(self, fingerprints: np.ndarray) -> np.ndarray:
+        found = np.zeros(fingerprints.shape, dtype=bool)
+        for run in self.runs:
+            positions = np.minimum(np.searchsorted(run, fingerprints), run.size - 1)
+            found |= run[positions] == fingerprints
+        return found
+
+    def add(self, fingerprints: np.ndarray) -> None:
+        """Adds fingerprints that are not yet in the set"""
+        if not fingerprints.size:
+            return
+        self.runs.append(np.unique(fingerprints))
+        while len(self.runs) > 1 and self.runs[-2].size <= 2 * self.runs[-1].size:
+            last = self.runs.pop()
+            self.runs[-1] = np.union1d(self.runs[-1], last)
+
+    def to_array(self) -> np.ndarray:
+        if not self.runs:
+            return np.array([], dtype=np.uint64)
+        return self.runs[0] if len(self.runs) == 1 else np.unique(np.concatenate(self.runs))
+
+    def digest(self) -> str:
+        """Fingerprint of the set. Datasets with the same rows have the same digest"""
+        return hashlib.blake2b(self.to_array().tobytes(), digest_size=16).hexdigest()
+
+
+def load_fingerprints(dataset_path: str) -> FingerprintSet:
+    """
+    Loads the fingerprints of the rows in a dataset from its sidecar file.
+    If the sidecar does not exist, the fingerprints are computed from the dataset.
+
+    :param dataset_path: Path to dataset
+    :return: FingerprintSet
+    """
+    fingerprints_path = sidecar_path(dataset_path, 'fingerprints.npy')
+    if os.path.exists(fingerprints_path):
+        return FingerprintSet(np.load(fingerprints_path))
+    logger.info("No fingerprints found for %s. Computing them from the dataset", dataset_path)
+    return FingerprintSet(row_fingerprints(read_dataset(dataset_path)))
+
+
+def save_fingerprints(fingerprints: FingerprintSet, dataset_path: str) -> None:
+    fingerprints_path = sidecar_path(dataset_path, 'fingerprints.npy')
+    tmp_path = f'{fingerprints_path}.tmp{os.getpid()}.npy'
+    np.save(tmp_path, fingerprints.to_array(), allow_pickle=False)
+    os.replace(tmp_path, fingerprints_path)
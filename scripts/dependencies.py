@@ -0,0 +1,159 @@
+import json
+import os
+import re
+import threading
+import time
+from importlib import metadata
+
+from packaging.version import InvalidVersion
+from packaging.version import Version
+
+# Matches pins such as '- pandas==1.2.3' or '- python=3.9' in environment.yml
+PIN_PATTERN = re.compile(r'^\s*-\s*([A-Za-z0-9_.\-]+)\s*==?\s*([A-Za-z0-9_.+!\-]+)\s*$')
+
+
+def normalise_name(name: str) -> str:
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def version_key(version: str):
+    """
+    Sort key for PEP 440 versions such as '1.2.3', '1.20' or '2.0rc1'. Pre-releases sort before their release.
+
+    :return: Version or None if version does not follow PEP 440
+    """
+    try:
+        return Version(version)
+    except InvalidVersion:
+        return None
+
+
+def installed_versions() -> dict:
+    """
+    :return: Versions of the packages installed in the running interpreter, read without spawning pip
+    """
+    versions = {}
+    for dist in metadata.distributions():
+        name = dist.metadata['Name']
+        if name:
+            versions[normalise_name(name)] = dist.version
+    return versions
+
+
+def pinned_versions(environment_file: str) -> dict:
+    """
+    Reads the versions pinned in a conda environment file. Conda and pip dependencies are both read.
+
+    :param environment_file: Path to environment.yml
+    :return: Dictionary of package name to pinned version
+    """
+    if not os.path.exists(environment_file):
+        return {}
+    pins = {}
+    with open(environment_file, 'r') as f:
+        for line in f:
+            match = PIN_PATTERN.match(line)
+            if match:
+                pins[normalise_name(match.group(1))] = match.group(2)
+    return pins
+
+
+def reference_versions(environment_file: str, index_path: str = None) -> dict:
+    """
+    Versions installed packages are compared against.
+    A local index {<package>: <latest version>} takes precedence over the pins in environment_file.
+
+    :param environment_file: Path to environment.yml
+    :param index_path: Path to JSON index of latest versions
+    :return: Dictionary of package name to reference version
+    """
+    versions = pinned_versions(environment_file)
+    if index_path and os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            versions.update({normalise_name(k): v for k, v in json.load(f).items()})
+    return versions
+
+
+def find_outdated_packages(installed: dict, reference: dict) -> list:
+    """
+    :param installed: Installed versions
+    :param reference: Reference versions
+    :return: [(package, installed version, reference version)] for packages older than their reference
+    """
+    outdated = []
+    for name in sorted(installed):
+        if name not in reference:
+            continue
+        installed_version, reference_version = version_key(installed[name]), version_key(reference[name])
+        # Versions that do not follow PEP 440 cannot be ordered, so they are not reported
+        if installed_version is not None and reference_version is not None and installed_version < reference_version:
+            outdated.append((name, installed[name], reference[name]))
+    return outdated
+
+
+def format_packages(packages: list) -> str:
+    """
+    Formats packages as columns like 'pip list --outdated --format columns'
+    """
+    rows = [('Package', 'Version', 'Latest')] + list(packages)
+    widths = [max(len(row[i]) for row in rows) for i in range(3)]
+    lines = [' '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows]
+    lines.insert(1, ' '.join('-' * width for width in widths))
+    return '\n'.join(lines) + '\n'
+
+
+class DependencyAudit:
+    """
+    Keeps the list of outdated packages in memory.
+    Once the list is older than ttl seconds, it is refreshed in a background thread
+    and the cached list is served until the refresh has finished.
+    """
+    def __init__(self, environment_file: str = 'environment.yml', index_path: str = None, ttl: float = 3600):
+        self.environment_file = environment_file
+        self.index_path = index_path
+        self.ttl = ttl
+        self._result = None
+        self._refreshed_at = 0.0
+        self._refreshing = threading.Lock()
+
+    def refresh(self) -> str:
+        result = format_packages(find_outdated_packages(
+            installed_versions(), reference_versions(self.environment_file, self.index_path)
+        ))
+        self._result, self._refreshed_at = result, time.time()
+        return result
+
+    def _refresh_in_background(self) -> None:
+        try:
+            self.refresh()
+        finally:
+            self._refreshing.release()
+
+    def get(self) -> str:
+        """
+        :return: Outdated packages formatted as columns
+        """
+        if self._result is None:
+            return self.refresh()
+        if time.time() - self._refreshed_at > self.ttl and self._refreshing.acquire(blocking=False):
+            threading.Thread(target=self._refresh_in_background, daemon=True).start()
+        return self._result
+
+
+_default_audit = None
+
+
+def get_default_audit() -> DependencyAudit:
+    """
+    Audit configured by 'environment_file', 'dependency_index' and 'dependency_audit_ttl' in config.json
+    """
+    global _default_audit
+    if _default_audit is None:
+        with open('config.json', 'r') as f:
+            config = json.load(f)
+        _default_audit = DependencyAudit(
+            environment_file=config.get('environment_file', 'environment.yml'),
+            index_path=config.get('dependency_index'),
+            ttl=config.get('dependency_audit_ttl', 3600)
+        )
+    return _default_audit
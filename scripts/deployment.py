@@ -1,25 +1,191 @@
+import argparse
 import json
+import logging
 import os
 import shutil
+import time
 
+from scripts.drift import reference_profile_path
+from scripts.fileindex import index_path
+from scripts.utils import configure_logging
+from scripts.utils import CURRENT_RELEASE
 from scripts.utils import get_latest_file
+from scripts.utils import resolve_release
 
+logger = logging.getLogger(__name__)
 
-def store_production_files(dst: str, *args) -> None:
+RELEASES_DIR = 'releases'
+# Files a release may contain. Each is linked from the deployment directory through the current release,
+# so a file missing from the current release is missing from the deployment as well
+RELEASE_FILES = (
+    'trainedmodel.pkl',
+    'trainedmodel.npz',
+    'latestscore.txt',
+    'ingestedfiles.txt',
+    'ingestedfiles.json',
+    'referenceprofile.json',
+)
+
+
+def production_name(path: str) -> str:
+    """
+    Name of a file in production, e.g. trainedmodel.pkl for models/trainedmodel_210407131937.pkl
+    """
+    filename = os.path.basename(path)
+    return filename.split('_')[0] + '.' + filename.split('.')[-1]
+
+
+def link_or_copy(src: str, dst: str) -> None:
+    """
+    Hardlinks src to dst so no bytes are copied. Falls back to a copy where the filesystem
+    does not support hardlinks or src is on another device
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def replace_symlink(target: str, path: str) -> None:
+    """
+    Points the symlink at path to target in one atomic rename. A file already at path is replaced
+    """
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    os.symlink(target, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _release_key(release: str) -> tuple:
+    # Releases are named <timestamp> or <timestamp>.<n> when several are made within a second
+    timestamp, _, n = release.partition('.')
+    return timestamp, int(n or 0)
+
+
+def list_releases(deployment_path: str) -> list:
+    """
+    :return: Names of the releases in deployment_path from oldest to newest
+    """
+    releases_dir = os.path.join(deployment_path, RELEASES_DIR)
+    if not os.path.isdir(releases_dir):
+        return []
+    return sorted((f for f in os.listdir(releases_dir) if not f.startswith('.')), key=_release_key)
+
+
+def current_release(deployment_path: str):
+    """
+    :return: Name of the release being served or None if deployment_path has no releases
+    """
+    release = resolve_release(deployment_path)
+    return os.path.basename(release) if release != deployment_path else None
+
+
+def stage_release(deployment_path: str, *files) -> str:
     """
-    Copy files from their source directories to a destination dir
+    Builds a complete release directory from files under their production names.
+    The release is assembled under a hidden name and renamed when it is complete.
 
-    :param dst: Destination dir to copy files
-    :param args: Files to be be copied
+    :param deployment_path: Production deployment directory
+    :param files: Files to be released
+    :return: Name of the release
+    """
+    releases_dir = os.path.join(deployment_path, RELEASES_DIR)
+    os.makedirs(releases_dir, exist_ok=True)
+    release = time.strftime('%y%m%d%H%M%S')
+    releases = list_releases(deployment_path)
+    # Names only ever increase, so the newest release sorts last even after older ones were removed
+    if releases and _release_key(release) <= _release_key(releases[-1]):
+        timestamp, n = _release_key(releases[-1])
+        release = f'{timestamp}.{n + 1}'
+
+    staging_dir = os.path.join(releases_dir, f'.{release}.tmp{os.getpid()}')
+    os.makedirs(staging_dir)
+    for f in files:
+        path = os.path.join(staging_dir, production_name(f))
+        logger.info('Linking %s to %s', f, path)
+        link_or_copy(f, path)
+    os.rename(staging_dir, os.path.join(releases_dir, release))
+    return release
+
+
+def activate_release(deployment_path: str, release: str) -> None:
+    """
+    Promotes a release by pointing the current link at it in one atomic rename.
+    Release files in deployment_path are links through the current link, so they all change at once
+
+    :param deployment_path: Production deployment directory
+    :param release: Name of release
     :return: None
     """
-    os.makedirs(dst, exist_ok=True)
-    for f in args:
-        filename = f.split(os.sep)[1]
-        new_filename = filename.split('_')[0] + '.' + filename.split('.')[-1]
-        path = os.path.join(dst, new_filename)
-        print(f'Copying {f} to {path}')
-        shutil.copy2(f, path)
+    release_dir = os.path.join(RELEASES_DIR, release)
+    if not os.path.isdir(os.path.join(deployment_path, release_dir)):
+        raise FileNotFoundError(f"No release {release} in {deployment_path}")
+
+    logger.info("Promoting release %s in %s", release, deployment_path)
+    replace_symlink(release_dir, os.path.join(deployment_path, CURRENT_RELEASE))
+    # Files deployed before releases existed are replaced by links once
+    for name in RELEASE_FILES:
+        path = os.path.join(deployment_path, name)
+        target = os.path.join(CURRENT_RELEASE, name)
+        if not os.path.islink(path) or os.readlink(path) != target:
+            replace_symlink(target, path)
+
+
+def prune_releases(deployment_path: str, keep: int) -> None:
+    """
+    Deletes all but the latest keep releases. The current release is always kept
+    """
+    current = current_release(deployment_path)
+    for release in list_releases(deployment_path)[:-keep]:
+        if release != current:
+            logger.info("Removing release %s", release)
+            shutil.rmtree(os.path.join(deployment_path, RELEASES_DIR, release), ignore_errors=True)
+
+
+def rollback(deployment_path: str, release: str = None) -> str:
+    """
+    Promotes the release before the current one again, or the given release
+
+    :param deployment_path: Production deployment directory
+    :param release: Name of release. Default is the release before the current one
+    :return: Name of the release promoted
+    """
+    if release is None:
+        releases = list_releases(deployment_path)
+        current = current_release(deployment_path)
+        older = releases[:releases.index(current)] if current in releases else []
+        if not older:
+            raise FileNotFoundError(f"No release before {current} in {deployment_path}")
+        release = older[-1]
+    activate_release(deployment_path, release)
+    return release
+
+
+def deploy_files(
+        model_path: str, metric_path: str, ingest_record_path: str, deployment_path: str, keep_releases: int = 5
+) -> str:
+    """
+    Releases a model together with its exported scorer, the reference profile and ingestion record
+    of the data it was trained on and its score to deployment_path. See stage_release and activate_release
+
+    :param keep_releases: Number of releases kept for rollback
+    :return: Name of the release
+    """
+    production_files = [model_path, metric_path, ingest_record_path]
+    scorer_path = os.path.splitext(model_path)[0] + '.npz'
+    if os.path.exists(scorer_path):
+        production_files.append(scorer_path)
+    profile_path = reference_profile_path(model_path)
+    if os.path.exists(profile_path):
+        production_files.append(profile_path)
+    if os.path.exists(index_path(ingest_record_path)):
+        production_files.append(index_path(ingest_record_path))
+
+    release = stage_release(deployment_path, *production_files)
+    activate_release(deployment_path, release)
+    prune_releases(deployment_path, keep_releases)
+    return release
 
 
 def main():
@@ -33,9 +199,20 @@ def main():
     model_path = get_latest_file(model_dir, 'trainedmodel_*.pkl')
     metric_path = get_latest_file(model_dir, "latestscore_*.txt")
     ingest_record_path = get_latest_file(output_folder_path, "ingestedfiles_*.txt")
-
-    store_production_files(deployment_path, model_path, metric_path, ingest_record_path)
+    deploy_files(
+        model_path, metric_path, ingest_record_path, deployment_path, keep_releases=config.get('release_retention', 5)
+    )
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Deploys the latest model or rolls back to an earlier release")
+    parser.add_argument('--rollback', action='store_true', help="Promote the release before the current one")
+    parser.add_argument('--release', default=None, help="Release to be promoted with --rollback")
+    args = parser.parse_args()
+
+    configure_logging()
+    if args.rollback:
+        with open('config.json', 'r') as f:
+            rollback(json.load(f)['prod_deployment_path'], args.release)
+    else:
+        main()
@@ -1,128 +1,179 @@
+import logging
 import os
 import json
-import subprocess
-import time
+import shutil
+import tempfile
 import timeit
+from typing import TYPE_CHECKING
 
+import numpy as np
 from pandas import DataFrame
-from sklearn.linear_model import LogisticRegression
 
+from scripts.dependencies import DependencyAudit
+from scripts.dependencies import get_default_audit
+from scripts.inference import load_scorer
+from scripts.ingestion import main as ingest
+from scripts.registry import REGISTRY_FILE
+from scripts.summary import DatasetStats
+from scripts.training import main as train
 from scripts.training import prepare_dataset
+from scripts.utils import configure_logging
 from scripts.utils import load_model
 
+logger = logging.getLogger(__name__)
 
-def model_predictions(data: DataFrame, model_path: str = None, model: LogisticRegression = None) -> list:
+if TYPE_CHECKING:
+    from sklearn.linear_model import LogisticRegression
+
+
+def model_predictions(data: DataFrame, model_path: str = None, model: 'LogisticRegression' = None) -> list:
     """
     Make predictions on input data using model found in model_path
     :param data: Data for which predictions are to be made
     :param model_path: Directory containing model pkl file
-    :param model: Fitted model. Is used if passed else model is loaded from model_path
+    :param model: Fitted model. Is used if passed else model is loaded from model_path.
+    The exported LinearScorer is preferred over the pickled model when it exists
     :return: List of model predictions
     """
     assert any([model, model_path]), "model or model_path must be passed into function"
     if not model:
-        model = load_model(model_path, is_deployed=True)
+        model = load_scorer(model_path, is_deployed=True) or load_model(model_path, is_deployed=True)
 
     predictions = model.predict(data)
-    return [float(x) for x in list(predictions)]
+    return np.asarray(predictions, dtype=float).tolist()
 
 
-def check_missing_values(data: DataFrame) -> DataFrame:
+def check_missing_values(data: DataFrame, stats: DatasetStats = None) -> list:
     """
     Checks % of missing values per column in data
     :param data: DataFrame to be checked for NA
+    :param stats: Summary statistics maintained during ingestion. If passed, data is not scanned.
     :return: List of missing values percentages in DataFrame columns
     """
+    if stats is not None:
+        return stats.missing_fractions(list(data.columns))
+
     missing_values_df = data.isna().sum() / data.shape[0]
-    print(missing_values_df)
+    logger.info(missing_values_df)
     return missing_values_df.values.tolist()
 
 
-def dataframe_summary(data: DataFrame) -> list:
+def dataframe_summary(data: DataFrame, stats: DatasetStats = None) -> list:
     """
     Summary statistics calculated are:
         - Mean
         - Median
         - Standard Deviation
     :param data: DataFrame to be summarised.
+    :param stats: Summary statistics maintained during ingestion. If passed, data is not scanned
+    and the median is read from its quantile sketch.
     :return: summary_dataframe.values.tolist()
     """
+    if stats is not None:
+        return stats.summary(list(data.columns))
+
     statistics = data.agg(["mean", "median", "std"])
     return statistics.values.tolist()
 
 
-def clean_up_diagnostic_files(start_time: str, end_time: str, folder: str) -> None:
+def copy_workspace(config: dict, workspace: str) -> dict:
     """
-    Clean up files creating during diagnosis
-    :param start_time: Start time of diagnostic operation in strftime('%y%m%d%H%M%S')
-    :param end_time: End time of diagnostic operation in strftime(''%y%m%d%H%M%S')
-    :param folder: Folder to which files were written
-    :return: None
+    Copies the ingested data into workspace and points a copy of config at it and at an empty model directory,
+    so that scripts run with the returned configuration never write to the live dataset or models.
+    Source and test data are only read and stay where they are. Registries are left out and rebuilt from the copies
+
+    :param config: Configuration
+    :param workspace: Empty directory
+    :return: Configuration of the workspace
     """
-    for f in os.listdir(folder):
-        if f'_{time.strftime("%y")}' not in f:
-            continue
-        creation_time = f.split('_')[1].split('.')[0]
-        if start_time <= creation_time <= end_time:
-            os.remove(os.path.join(folder, f))
-
-
-def check_execution_time(
-        training_script_output_dir: str,
-        ingestion_script_output_dir: str,
-        n_executions: int = 1000
-) -> list:
+    config = dict(config)
+    output_folder_path = os.path.join(workspace, 'ingesteddata')
+    if os.path.isdir(config['output_folder_path']):
+        shutil.copytree(
+            config['output_folder_path'], output_folder_path, ignore=shutil.ignore_patterns(f'{REGISTRY_FILE}*')
+        )
+    config['output_folder_path'] = output_folder_path
+    config['output_model_path'] = os.path.join(workspace, 'models')
+    os.makedirs(config['output_model_path'], exist_ok=True)
+    return config
+
+
+def check_execution_time(config: dict, n_executions: int = 3) -> list:
     """
     Calculates execution time for the ingestion and training script.
-    :param training_script_output_dir:
-    :param ingestion_script_output_dir:
-    :param n_executions: Number of executions to average from. Default is 1000.
-    :return: [training_script_time, ingestion_script_time]
+    The scripts are run in a temporary copy of the workspace, so files they ingest or models they train
+    do not change the live dataset. See copy_workspace
+    Ingestion is timed in full mode. The copy holds the up-to-date ingestion records, so an incremental run
+    would find nothing to ingest and measure nothing.
+
+    Times used to be the total of 1000 executions. They are now the average of n_executions, 3 by default,
+    since the training script fits every candidate of model_grid.
+
+    :param config: Configuration
+    :param n_executions: Number of executions to average from
+    :return: [training_script_time, ingestion_script_time] in seconds per execution
     """
-    print("Timing the training script...")
-    start_time = time.strftime('%y%m%d%H%M%S')
-    training_script_time = timeit.timeit(
-        stmt="main()", setup="from scripts.training import main", number=n_executions
-    )
-    end_time = time.strftime('%y%m%d%H%M%S')
-    print(f"Training script takes {training_script_time}s")
-    clean_up_diagnostic_files(start_time, end_time, training_script_output_dir)
-
-    print("Timing the ingestion script...")
-    start_time = time.strftime('%y%m%d%H%M%S')
-    ingestion_script_time = timeit.timeit(
-        stmt="main()", setup="from scripts.ingestion import main", number=n_executions
-    )
-    end_time = time.strftime('%y%m%d%H%M%S')
-    print(f"Ingestion script takes {ingestion_script_time}s")
-    clean_up_diagnostic_files(start_time, end_time, ingestion_script_output_dir)
+    with tempfile.TemporaryDirectory(prefix='adras-diagnostics-') as workspace:
+        workspace_config = copy_workspace(config, workspace)
+
+        logger.info("Timing the training script...")
+        training_script_time = timeit.timeit(
+            lambda: train(workspace_config), number=n_executions
+        ) / n_executions
+        logger.info("Training script takes %ss", training_script_time)
+
+        logger.info("Timing the ingestion script...")
+        ingestion_script_time = timeit.timeit(
+            lambda: ingest(dict(workspace_config, ingestion_mode='full')), number=n_executions
+        ) / n_executions
+        logger.info("Ingestion script takes %ss", ingestion_script_time)
     return [training_script_time, ingestion_script_time]
 
 
-def get_outdated_packages_list(output_dir: str) -> str:
+def get_outdated_packages_list(output_dir: str, audit: DependencyAudit = None) -> str:
     """
     Check the environment for outdated packages.
-    Uses 'pip list --outdated --format columns'.
-    :param output_dir: List is written to output_dir.
-    :return: None
+    Installed versions are read in-process and compared against environment.yml or a local index.
+    See scripts.dependencies
+    :param output_dir: List is written to output_dir if it has changed.
+    :param audit: DependencyAudit to use. Default is the audit configured in config.json
+    :return: Outdated packages formatted like 'pip list --outdated --format columns'
     """
-    print("Checking for outdated packages...")
-    process = subprocess.run(
-        "pip list --outdated --format columns",
-        shell=True,
-        capture_output=True,
-        check=True,
-        text=True
-    )
-    print(process.stdout)
+    logger.info("Checking for outdated packages...")
+    audit = audit or get_default_audit()
+    outdated_packages = audit.get()
+    logger.info(outdated_packages)
 
     outdated_packages_file = os.path.join(
         output_dir, "outdated_packages.txt"
     )
+    if os.path.exists(outdated_packages_file):
+        with open(outdated_packages_file, 'r') as f:
+            if f.read() == outdated_packages:
+                return outdated_packages
+
     with open(outdated_packages_file, 'w') as f:
-        print(f"Writing list of outdated packages to {outdated_packages_file}")
-        f.write(str(process.stdout))
-    return str(process.stdout)
+        logger.info("Writing list of outdated packages to %s", outdated_packages_file)
+        f.write(outdated_packages)
+    return outdated_packages
+
+
+def run_diagnostics(data: DataFrame, config: dict, stats: DatasetStats = None) -> dict:
+    """
+    Runs all diagnostics that do not need the model
+    :param data: Training data
+    :param config: Configuration. The list of outdated packages is written to prod_deployment_path
+    :param stats: Summary statistics of the training data maintained during ingestion
+    :return: {'missing_values': <list>, 'execution_time': <list>, 'outdated_dependencies': <str>}
+    """
+    missing_values = check_missing_values(data, stats=stats)
+    execution_time = check_execution_time(config)
+    outdated_dependencies = get_outdated_packages_list(config['prod_deployment_path'])
+    return {
+        'missing_values': missing_values,
+        'execution_time': execution_time,
+        'outdated_dependencies': outdated_dependencies
+    }
 
 
 def main():
@@ -131,8 +182,6 @@ def main():
 
     dataset_csv_path = config['output_folder_path']
     deployment_path = config['prod_deployment_path']
-    model_dir = config['output_model_path']
-    output_folder_path = config['output_folder_path']
 
     data = prepare_dataset(
         dataset_csv_path,
@@ -143,12 +192,11 @@ def main():
     dataframe_summary(data)
     check_missing_values(data)
     model_predictions(data.drop("exited", axis=1), model_path=deployment_path)
-    check_execution_time(
-        training_script_output_dir=model_dir, ingestion_script_output_dir=output_folder_path
-    )
+    check_execution_time(config)
     # TODO: Should diagnostics be written to deployment path?
     get_outdated_packages_list(deployment_path)
 
 
 if __name__ == '__main__':
+    configure_logging()
     main()
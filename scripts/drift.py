@@ -0,0 +1,175 @@
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+from pandas import DataFrame
+
+from scripts.registry import register
+from scripts.summary import DatasetStats
+
+logger = logging.getLogger(__name__)
+
+# Points at which distributions are compared: the percentiles of the reference data
+QUANTILES = np.linspace(0, 1, 101)
+# PSI compares the fraction of rows in each decile of the reference data
+PSI_BINS = np.arange(10, 100, 10)
+PSI_EPSILON = 1e-4
+
+
+def reference_profile_path(model_path: str) -> str:
+    """
+    :param model_path: Path to trainedmodel_<timestamp>.pkl
+    :return: Path to referenceprofile_<timestamp>.json next to it
+    """
+    directory, filename = os.path.split(model_path)
+    timestamp = os.path.splitext(filename)[0].split('_', 1)[-1]
+    return os.path.join(directory, f'referenceprofile_{timestamp}.json')
+
+
+def build_profile(stats: DatasetStats, columns: list) -> dict:
+    """
+    Profile of the distribution of the data a model was trained on, read from the running
+    summary statistics of the dataset, so the dataset itself is not read.
+
+    :param stats: Summary statistics of the training data. See scripts.summary
+    :param columns: Numeric columns to be profiled
+    :return: {'n_rows': ..., 'columns': {<column>: {'points': [<percentiles>], 'cdf': [<fraction of rows <= point>]}}}
+    """
+    profile = {'n_rows': stats.n_rows, 'columns': {}}
+    for column in columns:
+        column_stats = stats.numeric[column]
+        points = np.array([column_stats.quantile(q) for q in QUANTILES])
+        profile['columns'][column] = {'points': points.tolist(), 'cdf': column_stats.cdf(points).tolist()}
+    profile['id'] = hashlib.blake2b(json.dumps(profile, sort_keys=True).encode(), digest_size=16).hexdigest()
+    return profile
+
+
+def save_profile(profile: dict, path: str, parents: list = None) -> None:
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    logger.info("Writing reference profile to %s", path)
+    with open(path, 'w') as f:
+        json.dump(profile, f)
+    register(path, parents=parents)
+
+
+def load_profile(path: str):
+    """
+    :return: Reference profile or None if path does not exist
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def count_rows(profile: dict, df: DataFrame) -> dict:
+    """
+    Counts rows of df at or below every point of the profile. Counts of several batches can be added up
+
+    :param profile: Reference profile
+    :param df: New rows
+    :return: {<column>: {'n': <non-missing rows>, 'counts': [<rows <= point>]}}
+    """
+    counts = {}
+    for column, reference in profile['columns'].items():
+        values = df[column].to_numpy(dtype=np.float64) if df is not None and column in df else np.empty(0)
+        values = np.sort(values[~np.isnan(values)])
+        counts[column] = {
+            'n': int(values.size),
+            'counts': np.searchsorted(values, reference['points'], side='right').tolist()
+        }
+    return counts
+
+
+def merge_counts(counts: dict, other: dict) -> dict:
+    return {
+        column: {
+            'n': c['n'] + other[column]['n'],
+            'counts': (np.asarray(c['counts']) + other[column]['counts']).tolist()
+        }
+        for column, c in counts.items()
+    }
+
+
+def drift_statistics(profile: dict, counts: dict) -> dict:
+    """
+    Compares new rows to the reference profile.
+        - psi: Population stability index over the deciles of the reference data
+        - ks: Largest difference between the distribution functions at the percentiles of the reference data,
+        an approximation of the Kolmogorov-Smirnov statistic
+
+    :param profile: Reference profile
+    :param counts: Counts of new rows. See count_rows
+    :return: {<column>: {'psi': <float>, 'ks': <float>}}. Columns without new values are left out
+    """
+    statistics = {}
+    for column, reference in profile['columns'].items():
+        n = counts[column]['n']
+        if not n:
+            continue
+        reference_cdf = np.asarray(reference['cdf'])
+        new_cdf = np.asarray(counts[column]['counts']) / n
+
+        reference_fractions = np.diff(np.concatenate([[0.0], reference_cdf[PSI_BINS], [1.0]]))
+        new_fractions = np.diff(np.concatenate([[0.0], new_cdf[PSI_BINS], [1.0]]))
+        # Deciles that coincide because of repeated values are empty in both and do not contribute
+        non_empty = (reference_fractions > 0) | (new_fractions > 0)
+        reference_fractions = np.maximum(reference_fractions[non_empty], PSI_EPSILON)
+        new_fractions = np.maximum(new_fractions[non_empty], PSI_EPSILON)
+
+        statistics[column] = {
+            'psi': float(np.sum((new_fractions - reference_fractions) * np.log(new_fractions / reference_fractions))),
+            'ks': float(np.abs(new_cdf - reference_cdf).max())
+        }
+    return statistics
+
+
+def detect_drift(statistics: dict, psi_threshold: float = 0.2, ks_threshold: float = 0.1) -> list:
+    """
+    :param statistics: Statistics returned by drift_statistics
+    :param psi_threshold: PSI above which a column has drifted. 0.1 to 0.2 is commonly read as a moderate shift
+    :param ks_threshold: KS statistic above which a column has drifted
+    :return: Columns that have drifted
+    """
+    return [
+        column for column, s in statistics.items()
+        if s['psi'] > psi_threshold or s['ks'] > ks_threshold
+    ]
+
+
+def check_feature_drift(
+        profile: dict,
+        new_rows: DataFrame,
+        counts_file: str,
+        psi_threshold: float = 0.2,
+        ks_threshold: float = 0.1
+) -> list:
+    """
+    Compares all rows ingested since the reference profile was deployed to the profile.
+    Counts of earlier batches are kept in counts_file, so slow drift over many small batches is detected as well.
+
+    :param profile: Reference profile of the deployed model
+    :param new_rows: Rows ingested in this run
+    :param counts_file: File counts of new rows are kept in between runs
+    :param psi_threshold: See detect_drift
+    :param ks_threshold: See detect_drift
+    :return: Columns that have drifted
+    """
+    logger.info('Checking for feature drift...')
+    counts = count_rows(profile, new_rows)
+    if os.path.exists(counts_file):
+        with open(counts_file, 'r') as f:
+            stored = json.load(f)
+        # Counts of rows compared to an earlier profile are discarded once a new model is deployed
+        if stored['profile_id'] == profile['id']:
+            counts = merge_counts(stored['counts'], counts)
+    os.makedirs(os.path.dirname(counts_file) or '.', exist_ok=True)
+    with open(counts_file, 'w') as f:
+        json.dump({'profile_id': profile['id'], 'counts': counts}, f)
+
+    statistics = drift_statistics(profile, counts)
+    for column, s in statistics.items():
+        logger.info("%s: PSI %.4f, KS %.4f", column, s['psi'], s['ks'])
+    return detect_drift(statistics, psi_threshold=psi_threshold, ks_threshold=ks_threshold)
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+
+
+def normalise_path(path: str) -> str:
+    """
+    Spells a path the same way however it was written, e.g. './data//a.csv' and 'data/a.csv'
+
+    :param path: Path to file or directory
+    :return: Path relative to the working directory with symlinks resolved
+    """
+    return os.path.relpath(os.path.realpath(path))
+
+
+def content_hash(path: str, block_size: int = 1 << 20) -> str:
+    """
+    Hashes the content of a file in blocks of block_size bytes
+
+    :param path: Path to file
+    :param block_size: Number of bytes read at a time
+    :return: Hex digest of the file content
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_fingerprint(path: str, stat: os.stat_result = None) -> dict:
+    stat = stat or os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': content_hash(path)}
+
+
+def index_path(ingestion_record: str) -> str:
+    """
+    Path of the index stored next to an ingestion record, e.g. ingestedfiles.json for ingestedfiles.txt
+    """
+    return os.path.splitext(ingestion_record)[0] + '.json'
+
+
+def load_index(ingestion_record: str) -> dict:
+    """
+    Loads the index of ingested files kept next to ingestion_record.
+    Records written before the index existed only have paths, which are matched by path alone.
+
+    :param ingestion_record: Path to ingestedfiles*.txt
+    :return: Dictionary mapping normalised paths to their fingerprint or None if it is unknown
+    """
+    if os.path.exists(index_path(ingestion_record)):
+        with open(index_path(ingestion_record), 'r') as f:
+            return json.load(f)
+
+    if not os.path.exists(ingestion_record):
+        return {}
+    with open(ingestion_record, 'r') as f:
+        return {normalise_path(p): None for p in f.read().splitlines() if p}
+
+
+def save_index(index: dict, ingestion_record: str) -> None:
+    with open(index_path(ingestion_record), 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+
+
+def is_ingested(path: str, stat: os.stat_result, index: dict) -> bool:
+    """
+    A file is ingested if it is in the index with the same size and modification time.
+    If only the modification time changed, the content hash decides.
+
+    :param path: Normalised path to file
+    :param stat: os.stat result for the file
+    :param index: Index of ingested files
+    :return: True if the file content has already been ingested
+    """
+    if path not in index:
+        return False
+    fingerprint = index[path]
+    if fingerprint is None:
+        return True
+    if fingerprint['size'] != stat.st_size:
+        return False
+    return fingerprint['mtime_ns'] == stat.st_mtime_ns or fingerprint['hash'] == content_hash(path)
+
+
+def iter_new_files(dataset_dir: str, index: dict, extension: str = '.csv'):
+    """
+    Yields files in dataset_dir that are new or have changed since they were indexed
+
+    :param dataset_dir: Directory containing datasets
+    :param index: Index of ingested files
+    :param extension: Extension of dataset files
+    :return: Generator of (normalised path, os.stat result)
+    """
+    dataset_dir = normalise_path(dataset_dir)
+    with os.scandir(dataset_dir) as entries:
+        for entry in entries:
+            if not entry.name.endswith(extension) or not entry.is_file():
+                continue
+            path = os.path.join(dataset_dir, entry.name)
+            stat = entry.stat()
+            if not is_ingested(path, stat, index):
+                yield path, stat
+
+
+def find_new_files(dataset_dir: str, index: dict, extension: str = '.csv') -> list:
+    return sorted(path for path, _ in iter_new_files(dataset_dir, index, extension))
+
+
+def has_new_files(dataset_dir: str, index: dict, extension: str = '.csv') -> bool:
+    return next(iter_new_files(dataset_dir, index, extension), None) is not None
+
+
+def update_index(index: dict, paths: list) -> dict:
+    """
+    Records the fingerprints of newly ingested files
+
+    :param index: Index of ingested files
+    :param paths: Normalised paths of files that have been ingested
+    :return: Updated copy of index
+    """
+    index = dict(index)
+    for path in paths:
+        index[path] = file_fingerprint(path)
+    return index
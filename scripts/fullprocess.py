@@ -1,76 +1,255 @@
 import glob
 import json
+import logging
 import os
 from typing import Tuple
 
-from scripts.deployment import main as deploy
-from scripts.apicalls import main as make_api_calls
-from scripts.ingestion import main as ingest
-from scripts.reporting import main as report
-from scripts.scoring import main as score
-from scripts.training import main as train
+from scripts.cache import content_fingerprint
+from scripts.fileindex import has_new_files
+from scripts.pipeline import Artifact
+from scripts.pipeline import Pipeline
+from scripts.pipeline import Stage
+from scripts.pipeline import StopPipeline
+from scripts.registry import prune
+from scripts.utils import configure_logging
+from scripts.utils import get_ingestion_index
+from scripts.utils import get_latest_file
+from scripts.utils import load_model
 
+logger = logging.getLogger(__name__)
 
-def check_new_files(dataset_dir: str, ingestion_record: str) -> bool:
+
+def check_new_files(dataset_dir: str, output_dir: str) -> bool:
     """
-    Check for files in dataset_dir not in ingestion_record
+    Check for files in dataset_dir that have not been ingested into output_dir or changed since they were ingested.
+    Files are looked up in the latest ingestion index, the same one ingestion uses, so files that were ingested by
+    a run whose model was not deployed are not new. See scripts.utils.get_ingestion_index
     :param dataset_dir: Directory containing CSV datasets
-    :param ingestion_record: File containing list of already ingested datasets
+    :param output_dir: Directory containing ingestion records
     :return: True if new files exist in dataset_dir else False
     """
-    print('Checking for new files...')
-    with open(ingestion_record, 'r') as f:
-        ingested_files = f.read().splitlines()
-
-    candidate_files = glob.glob(f'{dataset_dir}/*.csv')
-    new_files = [f for f in candidate_files if f not in ingested_files]
-    return bool(new_files)
+    logger.info('Checking for new files...')
+    return has_new_files(dataset_dir, get_ingestion_index(output_dir, dataset_dir))
 
 
-def check_model_drift(metric_file: str) -> Tuple[bool, float, float]:
+def check_model_drift(metric_file: str, new_f1_score: float) -> Tuple[bool, float, float]:
     """
-    Train and score new model on latest finaldata_*.csv.
-    Compare new F1-Score to old one.
+    Compare F1-Score of new model to that of the deployed model.
     :param metric_file: File containing old F1-Score
+    :param new_f1_score: F1-Score of new model on test data
     :return: New F1-Score > Old F1-Score, new F1-Score, old F1-Score
     """
-    print('Checking for model drift...')
+    logger.info('Checking for model drift...')
     with open(metric_file, 'r') as f:
         old_f1_score = float(f.readline().strip())
 
-    train()
-    new_f1_score = score()
-
     return new_f1_score > old_f1_score, new_f1_score, old_f1_score
 
 
+def read_latest_score(model_path: str) -> dict:
+    from scripts.scoring import evaluation_path
+    from scripts.scoring import load_evaluation
+
+    metric_file = get_latest_file(model_path, 'latestscore_*.txt')
+    with open(metric_file, 'r') as f:
+        score = float(f.readline().strip())
+    return {'score': score, 'metric_file': metric_file, 'evaluation': load_evaluation(evaluation_path(metric_file))}
+
+
+def build_pipeline(config: dict) -> Pipeline:
+    """
+    Stages of the full process. The dataset, the model, the test data and its evaluation are handed
+    between stages in memory, and models, scores and reports are written in the background.
+    Training, scoring and reporting are skipped when the rows of the dataset, the test data
+    and the model they depend on have not changed since the last run.
+    With drift_detection, the process ends after ingestion unless the new rows have drifted from
+    the training data of the production model.
+    """
+    # The stages are imported here rather than with this module, so that a run
+    # that finds no new files ends before pandas, scikit-learn and matplotlib are imported
+    from scripts.apicalls import main as make_api_calls
+    from scripts.datastore import read_dataset
+    from scripts.deployment import deploy_files
+    from scripts.drift import build_profile
+    from scripts.drift import check_feature_drift
+    from scripts.drift import load_profile
+    from scripts.drift import reference_profile_path
+    from scripts.drift import save_profile
+    from scripts.inference import get_feature_names
+    from scripts.ingestion import run_ingestion
+    from scripts.reporting import report_evaluation
+    from scripts.scoring import evaluate_model
+    from scripts.scoring import evaluation_path
+    from scripts.scoring import new_score_path
+    from scripts.scoring import prepare_data
+    from scripts.scoring import save_evaluation
+    from scripts.scoring import write_score
+    from scripts.summary import load_stats
+    from scripts.training import fit_best_model
+    from scripts.training import new_model_path
+    from scripts.training import save_model
+    from scripts.training import set_dataset_state
+    from scripts.training import split_dataset
+    from scripts.training import warm_start_model
+
+    deployment_path = config['prod_deployment_path']
+    model_path = config['output_model_path']
+    test_data_path = config['test_data_path']
+    metric_file = os.path.join(deployment_path, 'latestscore.txt')
+
+    incremental_training = config.get('training_mode', 'full') == 'incremental'
+    drift_detection = config.get('drift_detection', False)
+    deployed_model_file = os.path.join(deployment_path, 'trainedmodel.pkl')
+
+    pipeline = Pipeline(
+        state_file=os.path.join(model_path, 'pipelinestate.json'),
+        trace_file=os.path.join(model_path, 'pipelinespans.jsonl'),
+        trace_memory=config.get('pipeline_trace_memory', False)
+    )
+
+    def ingest_stage() -> dict:
+        result = run_ingestion(config)
+        if result is None:
+            raise StopPipeline('No new data was ingested. Ending process...')
+        return {
+            'ingested': Artifact(result, result['fingerprint']),
+            'ingestion_record': result['ingestion_record']
+        }
+
+    def feature_drift_stage(ingested) -> dict:
+        profile = load_profile(os.path.join(deployment_path, 'referenceprofile.json'))
+        # Without a profile of the deployed model's training data, or once a new dataset is started, retrain
+        if not drift_detection or profile is None or not ingested['appended']:
+            return {}
+        drifted_columns = check_feature_drift(
+            profile,
+            # Only the rows ingested in this run and the profiled columns are read
+            read_dataset(
+                ingested['dataset_path'],
+                columns=list(profile['columns']),
+                start=ingested['first_new_row'],
+                stop=ingested['n_rows']
+            ),
+            counts_file=os.path.join(model_path, 'driftcounts.json'),
+            psi_threshold=config.get('drift_psi_threshold', 0.2),
+            ks_threshold=config.get('drift_ks_threshold', 0.1)
+        )
+        if not drifted_columns:
+            raise StopPipeline('New data has not drifted from the training data of the production model. '
+                               'Ending process...')
+        logger.info("Feature drift detected in %s", drifted_columns)
+        return {}
+
+    def load_test_data() -> dict:
+        return {'test_data': prepare_data(test_data_path, dropped_columns=['corporation'])}
+
+    def train_stage(ingested) -> dict:
+        model = None
+        # Every row appended to the dataset since the deployed model was trained on it updates the model,
+        # including rows of earlier runs that were not deployed. A new dataset is always fitted from scratch
+        if incremental_training and ingested['appended']:
+            model = warm_start_model(
+                load_model(deployment_path, is_deployed=True),
+                ingested['dataset_path'],
+                ingested['n_rows'],
+                full_refit_interval=config.get('full_refit_interval', 10)
+            )
+        if model is None:
+            dataset = read_dataset(ingested['dataset_path'], dropped_columns=['corporation'])
+            model = fit_best_model(
+                split_dataset(dataset, val_size=0.1),
+                grid=config.get('model_grid'),
+                n_workers=config.get('model_search_workers')
+            )
+            set_dataset_state(model, ingested['dataset_path'], dataset.shape[0])
+        model_file = new_model_path(model_path)
+        feature_names = get_feature_names(model)
+        pipeline.persist(
+            save_model, model, model_file, feature_names=feature_names, parents=[ingested['dataset_path']]
+        )
+        # Profile of the training data that data ingested later is compared to. See feature_drift_stage
+        profile = build_profile(load_stats(ingested['dataset_path']), feature_names + ['exited'])
+        pipeline.persist(save_profile, profile, reference_profile_path(model_file), parents=[model_file])
+        return {'model': model, 'model_file': model_file}
+
+    def load_trained_model() -> dict:
+        return {'model': load_model(model_path), 'model_file': get_latest_file(model_path, 'trainedmodel_*.pkl')}
+
+    def score_stage(model, model_file, test_data) -> dict:
+        # Predictions and confusion counts are kept for the report, so the model predicts once
+        evaluation = evaluate_model(test_data, model)
+        score_file = new_score_path(model_path)
+        pipeline.persist(write_score, evaluation['f1_score'], score_file, parents=[model_file])
+        pipeline.persist(save_evaluation, evaluation, evaluation_path(score_file))
+        return {'score': evaluation['f1_score'], 'metric_file': score_file, 'evaluation': evaluation}
+
+    def drift_stage(score) -> dict:
+        drift, new_score, old_score = check_model_drift(metric_file, score)
+        if not drift:
+            raise StopPipeline('Production model performs better. '
+                               f'New F1-Score: {new_score}. Old F1-Score: {old_score}')
+        return {}
+
+    def deploy_stage(model_file, metric_file, ingestion_record) -> dict:
+        deploy_files(
+            model_file,
+            metric_file,
+            ingestion_record,
+            deployment_path,
+            keep_releases=config.get('release_retention', 5)
+        )
+        return {}
+
+    def report_stage(evaluation) -> dict:
+        # Scores written before evaluations were kept have none
+        if evaluation is None:
+            evaluation = evaluate_model(pipeline.get('test_data'), pipeline.get('model'))
+        pipeline.persist(report_evaluation, evaluation, labels=['not exited', 'exited'], output_dir=model_path)
+        return {}
+
+    test_files = sorted(glob.glob(f'{test_data_path}/*.csv'))
+    pipeline.add(Stage('ingest', ingest_stage, outputs=['ingested', 'ingestion_record'], always_run=True))
+    pipeline.add(Stage('check_feature_drift', feature_drift_stage, inputs=['ingested'], always_run=True))
+    pipeline.add(Stage(
+        'load_test_data', load_test_data, outputs=['test_data'],
+        fingerprint=lambda: content_fingerprint(*test_files), load=load_test_data
+    ))
+    pipeline.add(Stage(
+        'train', train_stage, inputs=['ingested'], outputs=['model', 'model_file'], load=load_trained_model,
+        # Incremental training starts from the deployed model
+        fingerprint=lambda: content_fingerprint(deployed_model_file) if incremental_training else ''
+    ))
+    pipeline.add(Stage(
+        'score', score_stage, inputs=['model', 'model_file', 'test_data'],
+        outputs=['score', 'metric_file', 'evaluation'], load=lambda: read_latest_score(model_path)
+    ))
+    pipeline.add(Stage('check_model_drift', drift_stage, inputs=['score'], always_run=True))
+    pipeline.add(Stage(
+        'deploy', deploy_stage, inputs=['model_file', 'metric_file', 'ingestion_record'],
+        always_run=True, needs_persisted=True
+    ))
+    pipeline.add(Stage('report', report_stage, inputs=['evaluation']))
+    pipeline.add(Stage('api_calls', make_api_calls, always_run=True, needs_persisted=True))
+    return pipeline
+
+
 def main():
-    print("Running fullprocess...")
+    logger.info("Running fullprocess...")
     with open('config.json', 'r') as f:
         config = json.load(f)
 
     input_folder_path = config['input_folder_path']
-    deployment_path = config['prod_deployment_path']
-    model_path = config['output_model_path']
 
-    ingestion_record = os.path.join(deployment_path, 'ingestedfiles.txt')
-    if not check_new_files(input_folder_path, ingestion_record):
-        print(f'No new dataset in {input_folder_path}. Ending process...')
+    if not check_new_files(input_folder_path, config['output_folder_path']):
+        logger.info('No new dataset in %s. Ending process...', input_folder_path)
         exit()
 
-    ingest()
-
-    metric_file = os.path.join(deployment_path, 'latestscore.txt')
-    drift, new_score, old_score = check_model_drift(metric_file)
-    if not drift:
-        print('Production model performs better. '
-              f'New F1-Score: {new_score}. Old F1-Score: {old_score}')
-        exit()
+    build_pipeline(config).run()
 
-    deploy()
-    report()
-    make_api_calls()
+    if config.get('artifact_retention'):
+        prune([config['output_model_path'], config['output_folder_path']], config['artifact_retention'])
 
 
 if __name__ == '__main__':
+    configure_logging()
     main()
@@ -0,0 +1,350 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from operator import itemgetter
+
+import numpy as np
+
+from scripts.utils import get_latest_file
+from scripts.utils import load_model
+from scripts.utils import resolve_release
+
+logger = logging.getLogger(__name__)
+
+FEATURE_COLUMNS = ['lastmonth_activity', 'lastyear_activity', 'number_of_employees']
+
+
+def get_feature_names(model) -> list:
+    """
+    Feature columns in the order the model was fitted on
+
+    :param model: Fitted model
+    :return: model.feature_names_in_ if the model was fitted on a DataFrame else FEATURE_COLUMNS
+    """
+    feature_names = getattr(model, 'feature_names_in_', None)
+    return list(feature_names) if feature_names is not None else list(FEATURE_COLUMNS)
+
+
+def payload_to_array(payload: dict, feature_names: list) -> np.ndarray:
+    """
+    Builds a contiguous feature matrix from a /predict payload. Two layouts are accepted:
+        - pandas' orient='table': {'schema': {...}, 'data': [{<column>: <value>, ...}, ...]}
+        - columnar: {'columns': {<column>: [<value>, ...], ...}}
+    :param payload: Parsed JSON payload
+    :param feature_names: Feature columns in the order expected by the model
+    :return: Array of shape (n_rows, len(feature_names))
+    :raises ValueError: If a feature column is missing, columns differ in length or a value is missing or not finite
+    """
+    if 'columns' in payload:
+        columns = payload['columns']
+        missing = [c for c in feature_names if c not in columns]
+        if missing:
+            raise ValueError(f"Payload is missing feature columns: {missing}")
+        not_lists = [c for c in feature_names if not isinstance(columns[c], list)]
+        if not_lists:
+            raise ValueError(f"Feature columns must be lists of values: {not_lists}")
+        n_rows = len(columns[feature_names[0]])
+        # Assigning a list of another length to a column of X would broadcast a single value to every row
+        mismatched = {c: len(columns[c]) for c in feature_names if len(columns[c]) != n_rows}
+        if mismatched:
+            raise ValueError(f"Feature columns must all have {n_rows} values like {feature_names[0]}: {mismatched}")
+        X = np.empty((n_rows, len(feature_names)), dtype=np.float64)
+        for j, column in enumerate(feature_names):
+            X[:, j] = columns[column]
+    else:
+        rows = payload['data']
+        fields = {f['name'] for f in payload.get('schema', {}).get('fields', [])}
+        missing = [c for c in feature_names if fields and c not in fields]
+        if missing:
+            raise ValueError(f"Payload is missing feature columns: {missing}")
+        try:
+            values = list(map(itemgetter(*feature_names), rows))
+        except KeyError as e:
+            raise ValueError(f"Payload is missing feature column: {e}")
+        X = np.array(values, dtype=np.float64).reshape(len(rows), len(feature_names))
+
+    # None and NaN both become NaN, which the model would silently score as a label
+    not_finite = ~np.isfinite(X)
+    if not_finite.any():
+        row, feature = (indices[0] for indices in np.nonzero(not_finite))
+        raise ValueError(
+            f"Payload has {not_finite.sum()} missing or non-finite values, "
+            f"e.g. {feature_names[feature]} in row {row}"
+        )
+    return X
+
+
+def predict_array(model, X: np.ndarray) -> np.ndarray:
+    """
+    Predicts labels for a feature matrix in one vectorized call.
+    Binary linear models are scored directly from their coefficients, skipping sklearn's input validation.
+
+    :param model: Fitted model
+    :param X: Array of shape (n_rows, n_features) with columns ordered as get_feature_names(model)
+    :return: Array of predicted labels
+    """
+    coef = getattr(model, 'coef_', None)
+    classes = getattr(model, 'classes_', None)
+    if coef is None or classes is None or len(classes) != 2:
+        return model.predict(X)
+    scores = X @ coef[0] + model.intercept_[0]
+    return classes[(scores > 0).astype(np.intp)]
+
+
+class LinearScorer:
+    """
+    NumPy-only scorer for a fitted binary linear classifier such as LogisticRegression.
+    It is exported by scripts.training next to the pickled model as trainedmodel_*.npz
+    """
+    def __init__(
+            self,
+            coef: np.ndarray,
+            intercept: float,
+            classes: np.ndarray,
+            feature_names: list,
+            threshold: float = 0.5
+    ):
+        self.coef = np.ascontiguousarray(coef, dtype=np.float64).ravel()
+        self.intercept = float(intercept)
+        self.classes_ = np.asarray(classes)
+        self.feature_names_in_ = list(feature_names)
+        self.threshold = float(threshold)
+
+    @classmethod
+    def from_model(cls, model, feature_names: list = None, threshold: float = 0.5) -> 'LinearScorer':
+        return cls(
+            coef=model.coef_[0],
+            intercept=model.intercept_[0],
+            classes=model.classes_,
+            feature_names=feature_names or get_feature_names(model),
+            threshold=threshold
+        )
+
+    @classmethod
+    def load(cls, path: str) -> 'LinearScorer':
+        with np.load(path, allow_pickle=False) as artifact:
+            return cls(
+                coef=artifact['coef'],
+                intercept=artifact['intercept'],
+                classes=artifact['classes'],
+                feature_names=artifact['feature_names'].tolist(),
+                threshold=artifact['threshold']
+            )
+
+    def save(self, path: str) -> None:
+        with open(path, 'wb') as f:
+            np.savez(
+                f,
+                coef=self.coef,
+                intercept=self.intercept,
+                classes=self.classes_,
+                feature_names=np.array(self.feature_names_in_),
+                threshold=self.threshold
+            )
+
+    def _to_array(self, X) -> np.ndarray:
+        if hasattr(X, 'columns'):
+            X = X[self.feature_names_in_].to_numpy(dtype=np.float64)
+        return np.asarray(X, dtype=np.float64)
+
+    def predict_proba(self, X) -> np.ndarray:
+        """
+        :param X: Array of shape (n_rows, n_features) or DataFrame containing the feature columns
+        :return: Probability of the positive class for every row
+        """
+        scores = self._to_array(X) @ self.coef + self.intercept
+        return np.exp(-np.logaddexp(0, -scores))
+
+    def score(self, X) -> tuple:
+        """
+        :param X: Array of shape (n_rows, n_features) or DataFrame containing the feature columns
+        :return: Predicted labels, probability of the positive class
+        """
+        probabilities = self.predict_proba(X)
+        labels = self.classes_[(probabilities > self.threshold).astype(np.intp)]
+        return labels, probabilities
+
+    def predict(self, X) -> np.ndarray:
+        return self.score(X)[0]
+
+
+def load_scorer(model_path: str, is_deployed: bool = False):
+    """
+    Load scorer from npz file in model_path
+    :param model_path: Directory containing scorer npz file
+    :param is_deployed: Scorer being loaded is in production.
+    Filenames are different in development and production
+    :return: LinearScorer or None if the latest model in model_path has no scorer
+    """
+    latest_model = os.path.join(model_path, 'trainedmodel.pkl') if is_deployed \
+        else get_latest_file(model_path, 'trainedmodel_*.pkl')
+
+    # The scorer is only used if it was exported from the latest model
+    latest_scorer = os.path.splitext(latest_model)[0] + '.npz'
+    if latest_model and os.path.exists(latest_scorer):
+        return LinearScorer.load(latest_scorer)
+    return None
+
+
+def load_deployed_model(deployment_path: str):
+    """
+    :param deployment_path: Production deployment directory
+    :return: Deployed LinearScorer if it exists else the deployed pickled model
+    """
+    release = resolve_release(deployment_path)
+    return load_scorer(release, is_deployed=True) or load_model(release, is_deployed=True)
+
+
+class ModelWatcher:
+    """
+    Holds the deployed model and reloads it in a background thread when the deployed files change.
+    The model and its feature names are swapped in one assignment, so a request sees either
+    the old model or the new one and never waits for a reload.
+    """
+    watched_files = ('trainedmodel.pkl', 'trainedmodel.npz')
+
+    def __init__(self, deployment_path: str, interval: float = 5.0):
+        self.deployment_path = deployment_path
+        self.interval = interval
+        self._fingerprint = self._files_fingerprint()
+        self._pending = None
+        self._stop = threading.Event()
+        self._thread = None
+        model = load_deployed_model(deployment_path)
+        self.current = (model, get_feature_names(model))
+
+    @property
+    def model(self):
+        return self.current[0]
+
+    def _files_fingerprint(self) -> tuple:
+        fingerprint = []
+        for name in self.watched_files:
+            path = os.path.join(self.deployment_path, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                fingerprint.append(None)
+                continue
+            fingerprint.append((os.path.realpath(path), stat.st_mtime_ns, stat.st_size))
+        return tuple(fingerprint)
+
+    def check(self) -> bool:
+        """
+        Reloads the model if the deployed files changed and have not changed since the previous check,
+        so that a deployment that is still copying files is not picked up halfway.
+
+        :return: True if a new model was loaded
+        """
+        fingerprint = self._files_fingerprint()
+        if fingerprint == self._fingerprint:
+            self._pending = None
+            return False
+        if fingerprint != self._pending:
+            self._pending = fingerprint
+            return False
+
+        try:
+            model = load_deployed_model(self.deployment_path)
+        except Exception as e:
+            logger.warning("Failed to reload model from %s: %s", self.deployment_path, e)
+            return False
+        if model is None:
+            return False
+
+        self.current = (model, get_feature_names(model))
+        self._fingerprint = fingerprint
+        self._pending = None
+        logger.info("Reloaded model from %s", self.deployment_path)
+        return True
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def start(self) -> 'ModelWatcher':
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='model-watcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+class MicroBatcher:
+    """
+    Collects concurrent predict calls for up to window seconds or max_batch_size rows,
+    predicts them in one vectorized call and hands every caller its slice of the predictions.
+    """
+    def __init__(self, window: float = 0.002, max_batch_size: int = 1024):
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def predict(self, model, X: np.ndarray) -> np.ndarray:
+        """
+        :param model: Model the caller built X for
+        :param X: Array of shape (n_rows, n_features)
+        :return: Array of predicted labels for X
+        """
+        future = Future()
+        self._queue.put((model, X, future))
+        return future.result()
+
+    def _collect(self) -> list:
+        batch = [self._queue.get(timeout=0.1)]
+        n_rows = batch[0][1].shape[0]
+        deadline = time.monotonic() + self.window
+        while n_rows < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+            n_rows += batch[-1][1].shape[0]
+        return batch
+
+    def _predict_batch(self, batch: list) -> None:
+        # Requests built for a model that has since been swapped out are predicted with that model
+        by_model = {}
+        for item in batch:
+            by_model.setdefault(id(item[0]), []).append(item)
+        for items in by_model.values():
+            try:
+                predictions = predict_array(items[0][0], np.concatenate([X for _, X, _ in items]))
+            except Exception as e:
+                for _, _, future in items:
+                    future.set_exception(e)
+                continue
+            offsets = np.cumsum([X.shape[0] for _, X, _ in items])[:-1]
+            for (_, _, future), result in zip(items, np.split(predictions, offsets)):
+                future.set_result(result)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                batch = self._collect()
+            except queue.Empty:
+                continue
+            self._predict_batch(batch)
+
+    def start(self) -> 'MicroBatcher':
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -1,69 +1,264 @@
-import glob
 import json
+import logging
 import os
 import time
 
-import pandas as pd
+import numpy as np
 from pandas import DataFrame
 
+from scripts.datastore import compact_columnar
+from scripts.datastore import concat_frames
+from scripts.datastore import DATASET_EXTENSIONS
+from scripts.datastore import FingerprintSet
+from scripts.datastore import get_latest_dataset
+from scripts.datastore import is_columnar
+from scripts.datastore import iter_csv_files
+from scripts.datastore import load_fingerprints
+from scripts.datastore import PART_ROWS
+from scripts.datastore import read_dataset
+from scripts.datastore import row_fingerprints
+from scripts.datastore import save_fingerprints
+from scripts.datastore import write_dataset
+from scripts.fileindex import find_new_files
+from scripts.fileindex import save_index
+from scripts.fileindex import update_index
+from scripts.registry import get_artifact
+from scripts.registry import register
+from scripts.summary import DatasetStats
+from scripts.summary import load_stats
+from scripts.summary import save_stats
+from scripts.utils import configure_logging
+from scripts.utils import get_ingestion_index
 
-def merge_multiple_dataframe(input_dir: str, output_dir: str) -> DataFrame:
+logger = logging.getLogger(__name__)
+
+
+def find_new_datasets(input_dir: str, index: dict = None) -> list:
     """
-    Reads multiple CSV files into a pandas dataframe.
+    Lists CSV files in input_dir that are not in the index of ingested files or have changed since
 
     :param input_dir: path to directory containing CSV files
-    :param output_dir: list of ingested files are written to {output_dir}/ingestedfiles_*.txt
-    :return: DataFrame containing all CSV datasets found in path
+    :param index: Index of files that have already been ingested
+    :return: List of CSV files to be ingested
     """
+    new_datasets = find_new_files(input_dir, index or {})
+    logger.info("Found %s new files in %s.", len(new_datasets), input_dir)
+    return new_datasets
 
-    datasets = glob.glob(f'{input_dir}/*.csv')
-    print(f"Found {len(datasets)} files. Creating dataframe")
 
-    df = pd.concat(map(pd.read_csv, datasets))
+def write_ingestion_record(output_dir: str, index: dict, dataset_path: str = None) -> str:
+    """
+    Writes list of ingested files to {output_dir}/ingestedfiles_*.txt
+    and their fingerprints to {output_dir}/ingestedfiles_*.json
 
+    :param output_dir: Directory to which the record is written
+    :param index: Index of files that have been ingested
+    :param dataset_path: Dataset the files were ingested into. It is recorded as the record's parent in the registry
+    :return: Path to ingestion record
+    """
     os.makedirs(output_dir, exist_ok=True)
     output_path = f"{output_dir}/ingestedfiles_{time.strftime('%y%m%d%H%M%S')}.txt"
     with open(output_path, "w") as f:
-        print(f"Writing list of ingested files to {output_path}")
-        f.write("\n".join(datasets))
+        logger.info("Writing list of ingested files to %s", output_path)
+        f.write("\n".join(sorted(index)))
+    save_index(index, output_path)
+    register(output_path, parents=[dataset_path] if dataset_path else [])
+    return output_path
 
-    return df
 
-
-def clean_dataset(df: DataFrame) -> DataFrame:
+def clean_dataset(df: DataFrame, fingerprints: FingerprintSet = None) -> DataFrame:
     """
     All cleaning operations are done here.
     - Remove duplicate rows
+    - Remove rows whose fingerprints are in fingerprints i.e. rows that have been ingested before
 
     :param df: Input DataFrame to be cleaned
+    :param fingerprints: Fingerprints of previously ingested rows.
+    Fingerprints of the rows that are kept are added to it.
     :return: Cleaned DataFrame
     """
-    temp = df.copy(deep=True)
-    print(f"Input DataFrame is of shape: {temp.shape}")
-    print("Missing Values", temp.isna().sum(), sep="\n")
+    logger.info("Input DataFrame is of shape: %s", df.shape)
+    logger.info("Missing Values\n%s", df.isna().sum())
+
+    # Drop duplicate rows. Only the first occurrence of a fingerprint is kept
+    fingerprints = fingerprints if fingerprints is not None else FingerprintSet()
+    row_hashes = row_fingerprints(df)
+    _, first_rows = np.unique(row_hashes, return_index=True)
+    first_rows.sort()
+    new_rows = first_rows[~fingerprints.contains(row_hashes[first_rows])]
+    fingerprints.add(row_hashes[new_rows])
 
-    # Drop duplicate columns
-    temp.drop_duplicates(keep='first', ignore_index=True, inplace=True)
-    print(f"Dropped duplicate rows. DataFrame is of shape: {temp.shape}")
-    return temp
+    cleaned_df = df.iloc[new_rows].reset_index(drop=True)
+    logger.info("Dropped duplicate rows. DataFrame is of shape: %s", cleaned_df.shape)
+    return cleaned_df
 
 
-def main():
-    with open('config.json', 'r') as f:
-        config = json.load(f)
+def ingest_datasets(
+        datasets: list,
+        output_path: str,
+        fingerprints: FingerprintSet,
+        stats: DatasetStats = None,
+        append: bool = False,
+        chunksize: int = None,
+        n_workers: int = None
+) -> int:
+    """
+    Reads, cleans and writes datasets to output_path one chunk at a time.
+    Cleaned rows are buffered across files until chunksize rows have been collected, so that
+    many small files do not each become a part of a columnar dataset.
+    Only fingerprints of ingested rows, summary statistics and the buffered rows are kept in memory between chunks.
+
+    :param datasets: CSV files to be ingested
+    :param output_path: Dataset to which cleaned rows are written
+    :param fingerprints: Fingerprints of rows already in output_path
+    :param stats: Summary statistics of rows already in output_path. Updated with the ingested rows
+    :param append: Append to output_path instead of creating it
+    :param chunksize: Number of rows read at a time. If None, one file is read at a time.
+    :param n_workers: Number of threads reading files when chunksize is None
+    :return: Number of rows written
+    """
+    n_rows = 0
+    buffered = []
+    for chunk in iter_csv_files(datasets, chunksize=chunksize, n_workers=n_workers):
+        cleaned_chunk = clean_dataset(chunk, fingerprints)
+        if stats is not None:
+            stats.update(cleaned_chunk)
+        buffered.append(cleaned_chunk)
+        n_buffered = sum(df.shape[0] for df in buffered)
+        if n_buffered and n_buffered >= (chunksize or 0):
+            write_dataset(concat_frames(buffered), output_path, append=append or bool(n_rows))
+            n_rows += n_buffered
+            buffered = []
+
+    # A new dataset is written even if none of its rows are new
+    if buffered and (sum(df.shape[0] for df in buffered) or not (append or n_rows)):
+        write_dataset(concat_frames(buffered), output_path, append=append or bool(n_rows))
+        n_rows += sum(df.shape[0] for df in buffered)
+    return n_rows
+
+
+def new_dataset_path(output_dir: str, data_format: str) -> str:
+    return os.path.join(output_dir, f"finaldata_{time.strftime('%y%m%d%H%M%S')}{DATASET_EXTENSIONS[data_format]}")
+
+
+def convert_dataset(dataset_path: str, output_path: str, chunksize: int = None) -> None:
+    """
+    Copies a dataset to output_path in the format given by its extension, together with the fingerprints
+    and summary statistics of its rows, and registers the copy with the dataset as its parent.
+    Incremental ingestion uses it to move a dataset to data_format, e.g. the CSV dataset of an earlier
+    version to the columnar format, so that later runs append to the new format.
 
+    :param dataset_path: Path to dataset
+    :param output_path: Path to copy
+    :param chunksize: Number of rows of a CSV dataset read at a time
+    :return: None
+    """
+    logger.info("Converting %s to %s", dataset_path, output_path)
+    if is_columnar(dataset_path):
+        chunks = [read_dataset(dataset_path)]
+    else:
+        chunks = iter_csv_files([dataset_path], chunksize=chunksize)
+    for i, chunk in enumerate(chunks):
+        write_dataset(chunk, output_path, append=i > 0)
+
+    fingerprints = load_fingerprints(dataset_path)
+    save_fingerprints(fingerprints, output_path)
+    save_stats(load_stats(dataset_path), output_path)
+    register(output_path, parents=[dataset_path], digest=fingerprints.digest())
+
+
+def run_ingestion(config: dict):
+    """
+    Ingests new files from input_folder_path into the latest dataset in output_folder_path
+    or, in full ingestion mode, into a new dataset.
+    A latest dataset in another format than data_format is converted to data_format first. See convert_dataset
+    Small parts of a columnar dataset are merged afterwards. See compact_columnar
+
+    :param config: Configuration
+    :return: None if there was nothing to ingest else
+        {
+            'dataset_path': <path>,
+            'appended': <True if rows were appended to an existing dataset>,
+            'first_new_row': <index of the first row ingested in this run>,
+            'n_rows': <number of rows in the dataset>,
+            'fingerprint': <digest of the row fingerprints of the dataset>,
+            'ingestion_record': <path>
+        }
+    Rows are appended to the end of the dataset, so read_dataset(dataset_path, start=first_new_row) reads the
+    rows ingested in this run. If appended is False, first_new_row is 0.
+    """
     input_folder_path = config['input_folder_path']
     output_folder_path = config['output_folder_path']
+    incremental = config.get('ingestion_mode', 'full') == 'incremental'
+    data_format = config.get('data_format', 'csv')
+    n_workers = config.get('loader_workers')
+    chunksize = config.get('ingestion_chunksize')
 
-    concat_df = merge_multiple_dataframe(input_folder_path, output_folder_path)
-    cleaned_df = clean_dataset(concat_df)
+    index = get_ingestion_index(output_folder_path, input_folder_path) if incremental else {}
+    latest_dataset = get_latest_dataset(output_folder_path) if index else ''
 
-    output_df_path = os.path.join(
-        output_folder_path, f"finaldata_{time.strftime('%y%m%d%H%M%S')}.csv"
+    if latest_dataset and os.path.splitext(latest_dataset)[1] != DATASET_EXTENSIONS[data_format]:
+        converted_dataset = new_dataset_path(output_folder_path, data_format)
+        convert_dataset(latest_dataset, converted_dataset, chunksize=chunksize)
+        latest_dataset = converted_dataset
+
+    if latest_dataset:
+        output_df_path = latest_dataset
+        fingerprints = load_fingerprints(latest_dataset)
+        stats = load_stats(latest_dataset)
+    else:
+        index = {}
+        output_df_path = new_dataset_path(output_folder_path, data_format)
+        fingerprints = FingerprintSet()
+        stats = DatasetStats()
+
+    new_datasets = find_new_datasets(input_folder_path, index)
+    if not new_datasets:
+        logger.info("No new dataset in %s. Nothing to ingest", input_folder_path)
+        return None
+    index = update_index(index, new_datasets)
+
+    os.makedirs(output_folder_path, exist_ok=True)
+    logger.info("Writing cleaned data to %s", output_df_path)
+    first_new_row = len(fingerprints)
+    n_rows = ingest_datasets(
+        new_datasets,
+        output_df_path,
+        fingerprints,
+        stats=stats,
+        append=bool(latest_dataset),
+        chunksize=chunksize,
+        n_workers=n_workers
     )
-    print(f"Writing cleaned DataFrame to {output_df_path}")
-    cleaned_df.to_csv(output_df_path, index=False)
+    logger.info("Wrote %s new rows to %s", n_rows, output_df_path)
+    if is_columnar(output_df_path):
+        compact_columnar(output_df_path, target_rows=chunksize or PART_ROWS)
+    save_fingerprints(fingerprints, output_df_path)
+    save_stats(stats, output_df_path)
+    digest = fingerprints.digest()
+    # Parents recorded earlier, such as the dataset this one was converted from, are kept
+    record = get_artifact(output_df_path)
+    register(output_df_path, parents=sorted(set(index) | set(record['parents'] if record else [])), digest=digest)
+    ingestion_record = write_ingestion_record(output_folder_path, index, dataset_path=output_df_path)
+
+    return {
+        'dataset_path': output_df_path,
+        'appended': bool(latest_dataset),
+        'first_new_row': first_new_row,
+        'n_rows': len(fingerprints),
+        'fingerprint': digest,
+        'ingestion_record': ingestion_record
+    }
+
+
+def main(config: dict = None):
+    if config is None:
+        with open('config.json', 'r') as f:
+            config = json.load(f)
+
+    run_ingestion(config)
 
 
 if __name__ == '__main__':
+    configure_logging()
     main()
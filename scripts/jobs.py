@@ -0,0 +1,149 @@
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobManager:
+    """
+    Runs long jobs on a background executor and keeps their results.
+    Submitting a job while one with the same name is still running, or finished less than ttl seconds ago,
+    returns the existing job instead of starting a new one.
+    If store_dir is passed, jobs are also written there so that other server processes can look them up,
+    and the latest job of every name is recorded there, so a job already run by another process is reused as well.
+    """
+    def __init__(self, max_workers: int = 1, ttl: float = 600, store_dir: str = None):
+        self.ttl = ttl
+        self.store_dir = store_dir
+        if store_dir:
+            os.makedirs(store_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._jobs = {}
+        self._latest = {}
+        self._lock = threading.Lock()
+
+    def _is_reusable(self, job: dict) -> bool:
+        if job['status'] in (PENDING, RUNNING):
+            return True
+        return job['status'] == FINISHED and time.time() - job['finished_at'] < self.ttl
+
+    def submit(self, name: str, fn, *args, **kwargs) -> dict:
+        """
+        :param name: Name of job. Used to reuse running and recently finished jobs
+        :param fn: Callable to be run in the background
+        :return: Job. See get
+        """
+        with self._lock:
+            latest = self._jobs.get(self._latest.get(name))
+            if latest is not None and self._is_reusable(latest):
+                return dict(latest)
+
+            job_id = uuid.uuid4().hex
+            job = {
+                'job_id': job_id,
+                'name': name,
+                'status': PENDING,
+                'submitted_at': time.time(),
+                'finished_at': None,
+                'result': None,
+                'error': None
+            }
+            if self.store_dir:
+                latest = self._claim(name, job)
+                if latest is not None:
+                    return latest
+            self._jobs[job_id] = job
+            self._latest[name] = job_id
+        self._executor.submit(self._run, job, fn, *args, **kwargs)
+        return dict(job)
+
+    def _claim(self, name: str, job: dict):
+        """
+        Records job as the latest job of name in store_dir unless another process has a reusable job of that name.
+        The check and the record are made under an exclusive lock of a file in store_dir, which every
+        process opens, so two processes cannot both start a job. A pending or running job is only reused
+        while the process that started it is alive.
+
+        :return: Reusable job of another process or None if job was recorded
+        """
+        path = os.path.join(self.store_dir, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', name)}.latest")
+        with open(f'{path}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    lease = json.load(f)
+                latest = self.get(lease['job_id'])
+                if latest is not None and self._is_reusable(latest) and (
+                        latest['status'] == FINISHED or _is_alive(lease['pid'])):
+                    return latest
+
+            tmp_path = f'{path}.tmp{os.getpid()}'
+            with open(tmp_path, 'w') as f:
+                json.dump({'job_id': job['job_id'], 'pid': os.getpid()}, f)
+            os.replace(tmp_path, path)
+            # Stored before the lock is released, so other processes find the job of the record
+            self._store(job)
+        return None
+
+    def _store(self, job: dict) -> None:
+        if not self.store_dir:
+            return
+        path = os.path.join(self.store_dir, f"{job['job_id']}.json")
+        tmp_path = f'{path}.tmp{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp_path, path)
+
+    def _run(self, job: dict, fn, *args, **kwargs) -> None:
+        job['status'] = RUNNING
+        self._store(job)
+        try:
+            job['result'] = fn(*args, **kwargs)
+            job['status'] = FINISHED
+        except Exception as e:
+            # The traceback stays in the server's log. Jobs are returned to clients, so they only get the exception
+            logger.exception("Job %s (%s) failed", job['name'], job['job_id'])
+            job['error'] = f'{type(e).__name__}: {e}'
+            job['status'] = FAILED
+        job['finished_at'] = time.time()
+        self._store(job)
+
+    def get(self, job_id: str) -> dict:
+        """
+        :param job_id: Id returned by submit
+        :return: Copy of job with its status, result and error or None if job_id is unknown
+        """
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return dict(job)
+        if self.store_dir and re.fullmatch(r'[0-9a-f]{32}', job_id):
+            path = os.path.join(self.store_dir, f'{job_id}.json')
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    return json.load(f)
+        return None
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
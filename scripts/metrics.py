@@ -0,0 +1,167 @@
+import multiprocessing
+from bisect import bisect_left
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+INFERENCE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+# Responses are counted by status class, so every series can be allocated up front
+STATUS_CLASSES = ('1xx', '2xx', '3xx', '4xx', '5xx')
+# Endpoint label of requests that match no route
+UNMATCHED = 'unmatched'
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(names: tuple, values: tuple, **extra) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    """
+    Metric kept in shared memory. A metric created before a server forks its workers is updated by
+    all of them, so whichever worker answers a scrape reports the totals of every worker.
+    Shared memory cannot grow, so the label values of every series are declared when the metric is created.
+    """
+    kind = None
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            label_names: tuple = (),
+            label_values: list = ((),),
+            width: int = 1
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.series = [tuple(values) for values in label_values]
+        self._offsets = {values: i * width for i, values in enumerate(self.series)}
+        self._values = multiprocessing.RawArray('d', len(self.series) * width)
+        self._lock = multiprocessing.Lock()
+
+    def offset(self, labels: tuple) -> int:
+        try:
+            return self._offsets[tuple(labels)]
+        except KeyError:
+            raise KeyError(f"{self.name} has no series {dict(zip(self.label_names, labels))}") from None
+
+    def header(self) -> list:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount: float = 1.0) -> None:
+        offset = self.offset(labels)
+        with self._lock:
+            self._values[offset] += amount
+
+    def render(self) -> list:
+        lines = self.header()
+        for labels in self.series:
+            value = self._values[self.offset(labels)]
+            lines.append(f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}')
+        return lines
+
+
+class Histogram(Metric):
+    """
+    Counts observations in buckets. Each series keeps the count of every bucket, of observations
+    above the last bucket and the sum of observations. Buckets are reported cumulatively
+    """
+    kind = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            label_names: tuple = (),
+            label_values: list = ((),),
+            buckets: tuple = REQUEST_BUCKETS
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, label_names, label_values, width=len(self.buckets) + 2)
+
+    def observe(self, value: float, *labels) -> None:
+        offset = self.offset(labels)
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            self._values[offset + bucket] += 1
+            self._values[offset + len(self.buckets) + 1] += value
+
+    def render(self) -> list:
+        lines = self.header()
+        n_buckets = len(self.buckets)
+        for labels in self.series:
+            offset = self.offset(labels)
+            with self._lock:
+                values = self._values[offset:offset + n_buckets + 2]
+            count = 0.0
+            for le, n in zip([*map(repr, self.buckets), '+Inf'], values[:n_buckets + 1]):
+                count += n
+                lines.append(
+                    f'{self.name}_bucket{_format_labels(self.label_names, labels, le=le)} {_format_value(count)}'
+                )
+            lines.append(f'{self.name}_sum{_format_labels(self.label_names, labels)} {_format_value(values[-1])}')
+            lines.append(f'{self.name}_count{_format_labels(self.label_names, labels)} {_format_value(count)}')
+        return lines
+
+
+def render(*metrics: Metric) -> str:
+    """
+    :return: Metrics in the Prometheus text exposition format
+    """
+    return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+
+class RequestMetrics:
+    """
+    Metrics of an API: requests and their latency by endpoint, and the time spent predicting.
+    Inference is timed on its own so that it can be told apart from parsing payloads and serializing responses
+    """
+    def __init__(self, endpoints: list):
+        endpoints = [*endpoints, UNMATCHED]
+        self.requests = Counter(
+            'adras_http_requests_total',
+            'Requests served by endpoint and status class',
+            ('endpoint', 'status'),
+            [(endpoint, status) for endpoint in endpoints for status in STATUS_CLASSES]
+        )
+        self.latency = Histogram(
+            'adras_http_request_duration_seconds',
+            'Seconds spent serving a request by endpoint',
+            ('endpoint',),
+            [(endpoint,) for endpoint in endpoints]
+        )
+        self.inference = Histogram(
+            'adras_model_inference_seconds',
+            'Seconds spent predicting the rows of a request, including time spent waiting for a batch',
+            buckets=INFERENCE_BUCKETS
+        )
+        self.inference_rows = Counter('adras_model_inference_rows_total', 'Rows predicted')
+
+    def observe_request(self, endpoint: str, status_code: int, seconds: float) -> None:
+        status = f'{status_code // 100}xx'
+        if status not in STATUS_CLASSES:
+            status = '5xx'
+        self.requests.inc(endpoint, status)
+        self.latency.observe(seconds, endpoint)
+
+    def observe_inference(self, seconds: float, n_rows: int) -> None:
+        self.inference.observe(seconds)
+        self.inference_rows.inc(amount=n_rows)
+
+    def render(self) -> str:
+        return render(self.requests, self.latency, self.inference, self.inference_rows)
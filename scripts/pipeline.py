@@ -0,0 +1,268 @@
+import hashlib
+import json
+import logging
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class StopPipeline(Exception):
+    """
+    Raised by a stage to end a run early. Later stages are not run
+    """
+
+
+class Artifact:
+    """
+    Value returned by a stage together with a fingerprint of its content.
+    Stages that consume it are skipped when the fingerprint has not changed,
+    even if the stage that produced it ran again.
+    """
+    def __init__(self, value, fingerprint: str):
+        self.value = value
+        self.fingerprint = fingerprint
+
+
+class Stage:
+    """
+    Step of a Pipeline.
+        - fn is called with the values of inputs as keyword arguments and returns {<output>: <value or Artifact>}
+        - fingerprint returns a fingerprint of inputs that are not in the pipeline, such as files
+        - load returns the outputs without running fn. Only stages that have load or no outputs are skipped
+        - always_run stages are never skipped
+        - needs_persisted stages wait until every pending write has finished
+    """
+    def __init__(
+            self,
+            name: str,
+            fn,
+            inputs: tuple = (),
+            outputs: tuple = (),
+            fingerprint=None,
+            load=None,
+            always_run: bool = False,
+            needs_persisted: bool = False
+    ):
+        self.name = name
+        self.fn = fn
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.fingerprint = fingerprint
+        self.load = load
+        self.always_run = always_run
+        self.needs_persisted = needs_persisted
+
+    @property
+    def can_skip(self) -> bool:
+        return not self.always_run and (self.load is not None or not self.outputs)
+
+
+def combine_fingerprints(*parts: str) -> str:
+    return hashlib.blake2b('\0'.join(parts).encode(), digest_size=16).hexdigest()
+
+
+class Pipeline:
+    """
+    Runs stages in order and hands their outputs to later stages in memory.
+    Stages write their artifacts through persist, which writes them on a background thread
+    while later stages run. run waits for every write before it returns.
+
+    The fingerprint of a stage combines its name, the fingerprints of its inputs and its external fingerprint.
+    Fingerprints of the stages that completed are kept in state_file, and a stage whose fingerprint is
+    unchanged since it last completed is skipped. Its outputs are only loaded if a later stage that runs needs them.
+
+    Every run appends a span for each stage and one for the whole run to trace_file as JSON lines, with the
+    stage's status, its wall seconds, the CPU seconds of the process and its peak resident memory. With trace_memory
+    the peak of memory allocated by Python and NumPy during the stage is traced as well, which slows down stages
+    that allocate a lot.
+    """
+    def __init__(
+            self,
+            stages: list = None,
+            state_file: str = None,
+            persist_workers: int = 1,
+            trace_file: str = None,
+            trace_memory: bool = False
+    ):
+        self.stages = list(stages or [])
+        self.state_file = state_file
+        self.persist_workers = persist_workers
+        self.trace_file = trace_file
+        self.trace_memory = trace_memory
+        self.values = {}
+        self._fingerprints = {}
+        self._skipped = {}
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._executor = None
+
+    def add(self, stage: Stage) -> 'Pipeline':
+        self.stages.append(stage)
+        return self
+
+    def load_state(self) -> dict:
+        if self.state_file and os.path.exists(self.state_file):
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        return {}
+
+    def save_state(self, state: dict) -> None:
+        if not self.state_file:
+            return
+        os.makedirs(os.path.dirname(self.state_file) or '.', exist_ok=True)
+        tmp_path = f'{self.state_file}.tmp{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=4)
+        os.replace(tmp_path, self.state_file)
+
+    def save_spans(self, spans: list) -> None:
+        if not self.trace_file or not spans:
+            return
+        os.makedirs(os.path.dirname(self.trace_file) or '.', exist_ok=True)
+        with open(self.trace_file, 'a') as f:
+            f.write(''.join(json.dumps(span) + '\n' for span in spans))
+
+    def _span(self, run_id: str, name: str, status: str, start: float, cpu_start: float) -> dict:
+        return {
+            'run_id': run_id,
+            'stage': name,
+            'status': status,
+            'started_at': round(start, 3),
+            'seconds': round(time.time() - start, 6),
+            'cpu_seconds': round(time.process_time() - cpu_start, 6),
+            # Peak of memory allocated by Python and NumPy during the stage. None unless trace_memory is set
+            'peak_memory_mb': (
+                round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 3)
+                if self.trace_memory and status != 'skipped' and tracemalloc.is_tracing() else None
+            ),
+            # Peak resident memory of the process so far, including memory allocated by native libraries
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        }
+
+    def persist(self, fn, *args, **kwargs) -> Future:
+        """
+        Runs fn(*args, **kwargs) on the background writer. Use for writes whose result later stages do not read
+        """
+        future = self._executor.submit(fn, *args, **kwargs)
+        with self._pending_lock:
+            self._pending.append(future)
+        return future
+
+    def flush(self) -> None:
+        """
+        Waits for pending writes. Raises the first error a write raised
+        """
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+        errors = [future.exception() for future in pending]
+        errors = [e for e in errors if e is not None]
+        if errors:
+            raise errors[0]
+
+    def get(self, name: str):
+        """
+        :param name: Output of a stage
+        :return: Value of output. Outputs of skipped stages are loaded when they are first needed
+        """
+        if name not in self.values:
+            stage = self._skipped.pop(name)
+            logger.info("Loading outputs of skipped stage %s", stage.name)
+            outputs = stage.load()
+            for output in stage.outputs:
+                self._skipped.pop(output, None)
+                self.values[output] = outputs[output]
+        return self.values[name]
+
+    def stage_fingerprint(self, stage: Stage) -> str:
+        return combine_fingerprints(
+            stage.name,
+            *(self._fingerprints[name] for name in stage.inputs),
+            stage.fingerprint() if stage.fingerprint else ''
+        )
+
+    def _run_stage(self, stage: Stage, key: str) -> dict:
+        inputs = {name: self.get(name) for name in stage.inputs}
+        if stage.needs_persisted:
+            self.flush()
+        logger.info("Running stage %s", stage.name)
+        outputs = stage.fn(**inputs) or {}
+
+        fingerprints = {}
+        for name in stage.outputs:
+            value = outputs[name]
+            if isinstance(value, Artifact):
+                fingerprints[name], value = value.fingerprint, value.value
+            else:
+                fingerprints[name] = combine_fingerprints(key, name)
+            self.values[name] = value
+        return fingerprints
+
+    def run(self) -> bool:
+        """
+        :return: False if a stage stopped the run else True
+        """
+        state = self.load_state()
+        completed = {}
+        spans = []
+        run_id = time.strftime('%y%m%d%H%M%S')
+        run_start, run_cpu_start = time.time(), time.process_time()
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        self._executor = ThreadPoolExecutor(max_workers=self.persist_workers, thread_name_prefix='persist')
+        status = 'failed'
+        try:
+            for stage in self.stages:
+                key = self.stage_fingerprint(stage)
+                previous = state.get(stage.name)
+                if stage.can_skip and previous is not None and previous['key'] == key:
+                    logger.info("Skipping stage %s. Its inputs have not changed", stage.name)
+                    self._fingerprints.update(previous['outputs'])
+                    self._skipped.update({name: stage for name in stage.outputs})
+                    spans.append(self._span(run_id, stage.name, 'skipped', time.time(), time.process_time()))
+                    continue
+
+                if self.trace_memory:
+                    tracemalloc.reset_peak()
+                start, cpu_start = time.time(), time.process_time()
+                stage_status = 'failed'
+                try:
+                    fingerprints = self._run_stage(stage, key)
+                    stage_status = 'completed'
+                except StopPipeline:
+                    stage_status = 'stopped'
+                    raise
+                finally:
+                    spans.append(self._span(run_id, stage.name, stage_status, start, cpu_start))
+                self._fingerprints.update(fingerprints)
+                completed[stage.name] = {'key': key, 'outputs': fingerprints}
+            status = 'completed'
+        except StopPipeline as e:
+            status = 'stopped'
+            logger.info(e)
+            return False
+        finally:
+            # Stages are only recorded once their artifacts have been written
+            try:
+                self.flush()
+            except BaseException:
+                status = 'failed'
+                raise
+            finally:
+                self._executor.shutdown(wait=True)
+                # The run's span includes waiting for the writes of the last stages
+                run_span = self._span(run_id, 'run', status, run_start, run_cpu_start)
+                peaks = [span['peak_memory_mb'] for span in spans + [run_span] if span['peak_memory_mb'] is not None]
+                run_span['peak_memory_mb'] = max(peaks) if peaks else None
+                spans.append(run_span)
+                if started_tracing:
+                    tracemalloc.stop()
+                self.save_spans(spans)
+            self.save_state(dict(state, **completed))
+        return True
@@ -0,0 +1,302 @@
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import time
+from contextlib import closing
+from contextlib import contextmanager
+from typing import Optional
+
+from scripts.fileindex import content_hash
+from scripts.fileindex import normalise_path
+
+logger = logging.getLogger(__name__)
+
+REGISTRY_FILE = 'registry.db'
+
+# Timestamped artifacts and the extensions of their main file. Other files sharing an artifact's stem,
+# such as trainedmodel_*.npz or finaldata_*.stats.json, belong to it and are pruned with it
+ARTIFACT_KINDS = {
+    'trainedmodel': ('.pkl',),
+    'latestscore': ('.txt',),
+    'referenceprofile': ('.json',),
+    'apireturns': ('.txt',),
+    'loadtest': ('.txt',),
+    'finaldata': ('.csv', '.cols'),
+    'ingestedfiles': ('.txt',),
+}
+ARTIFACT_NAME = re.compile(r'(?P<kind>[a-z]+)_(?P<timestamp>\d{12})(?P<extension>\.[a-z]+)')
+ARTIFACT_PATTERN = re.compile(r'(?P<kind>[a-z]+)_\*(?P<extension>\.[a-z]+)')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    name TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    extension TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    content_hash TEXT,
+    parents TEXT NOT NULL,
+    registered_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_by_kind ON artifacts (kind, timestamp, name);
+"""
+# Stored in the registry's user_version once SCHEMA has been created
+SCHEMA_VERSION = 1
+
+
+def registry_path(directory: str) -> str:
+    return os.path.join(directory, REGISTRY_FILE)
+
+
+def parse_name(name: str) -> Optional[dict]:
+    """
+    :param name: Filename such as trainedmodel_210407131937.pkl
+    :return: {'kind': ..., 'timestamp': ..., 'extension': ...} or None if name is not an artifact of a known kind
+    """
+    match = ARTIFACT_NAME.fullmatch(name)
+    if match is None or match['extension'] not in ARTIFACT_KINDS.get(match['kind'], ()):
+        return None
+    return match.groupdict()
+
+
+def _hash(path: str) -> Optional[str]:
+    # Directories such as columnar datasets are registered without a hash unless one is passed in
+    return content_hash(path) if os.path.isfile(path) else None
+
+
+def _insert(connection: sqlite3.Connection, name: str, fields: dict, digest: Optional[str], parents: list) -> None:
+    connection.execute(
+        'INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (name, fields['kind'], fields['extension'], fields['timestamp'], digest, json.dumps(parents), time.time())
+    )
+
+
+def scan_directory(connection: sqlite3.Connection, directory: str) -> int:
+    """
+    Registers artifacts that are in directory but not in its registry, e.g. those written before it existed
+
+    :return: Number of artifacts registered
+    """
+    registered = {name for name, in connection.execute('SELECT name FROM artifacts')}
+    n_registered = 0
+    for name in sorted(os.listdir(directory)):
+        fields = parse_name(name)
+        if fields is None or name in registered:
+            continue
+        _insert(connection, name, fields, _hash(os.path.join(directory, name)), [])
+        n_registered += 1
+    return n_registered
+
+
+@contextmanager
+def open_registry(directory: str, create: bool = True):
+    """
+    Opens the registry of directory in a transaction. A new registry starts with the artifacts already in directory.
+    Connections are not kept open, so the registry can be used from threads and forked processes alike.
+
+    :param directory: Directory the artifacts are in
+    :param create: Create the registry if it does not exist. Otherwise None is yielded
+    :return: sqlite3.Connection or None
+    """
+    path = registry_path(directory)
+    exists = os.path.exists(path)
+    if not exists and not create:
+        yield None
+        return
+
+    os.makedirs(directory, exist_ok=True)
+    with closing(sqlite3.connect(path, timeout=30)) as connection:
+        connection.execute('PRAGMA synchronous=NORMAL')
+        # Lookups on request paths only read user_version. The schema is written once per registry
+        if connection.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+            create_schema(connection, directory)
+        with connection:
+            yield connection
+
+
+def create_schema(connection: sqlite3.Connection, directory: str) -> None:
+    """
+    Creates the tables of a registry and registers the artifacts already in directory. See scan_directory
+    The write lock is taken before user_version is read again, so only one of several processes opening a new
+    registry at the same time creates it.
+    """
+    connection.execute('PRAGMA journal_mode=WAL')
+    with connection:
+        connection.execute('BEGIN IMMEDIATE')
+        if connection.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+            return
+        logger.info("Creating artifact registry in %s", directory)
+        # executescript would commit the transaction, so statements are run one at a time
+        for statement in SCHEMA.split(';'):
+            if statement.strip():
+                connection.execute(statement)
+        scan_directory(connection, directory)
+        connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+
+def register(path: str, parents: list = None, digest: str = None) -> None:
+    """
+    Records an artifact that has been written in the registry of its directory
+
+    :param path: Path to artifact, named <kind>_<timestamp><extension>
+    :param parents: Paths of the artifacts it was made from, e.g. the dataset a model was trained on
+    :param digest: Hash of its content. Default is the hash of the file.
+    Datasets are registered with the digest of their row fingerprints instead
+    :return: None
+    """
+    directory, name = os.path.split(path)
+    fields = parse_name(name)
+    if fields is None:
+        raise ValueError(f"{name} is not named like an artifact of a known kind: {sorted(ARTIFACT_KINDS)}")
+    digest = digest or _hash(path)
+    parents = [normalise_path(p) for p in parents or []]
+    with open_registry(directory or '.') as connection:
+        _insert(connection, name, fields, digest, parents)
+
+
+def get_artifact(path: str) -> Optional[dict]:
+    """
+    :return: Registry record of the artifact at path or None if it is not registered
+    """
+    directory, name = os.path.split(path)
+    with open_registry(directory or '.', create=False) as connection:
+        row = connection and connection.execute(
+            'SELECT kind, timestamp, content_hash, parents, registered_at FROM artifacts WHERE name = ?', (name,)
+        ).fetchone()
+    if not row:
+        return None
+    kind, timestamp, digest, parents, registered_at = row
+    return {
+        'path': path,
+        'kind': kind,
+        'timestamp': timestamp,
+        'content_hash': digest,
+        'parents': json.loads(parents),
+        'registered_at': registered_at
+    }
+
+
+def latest_artifact(directory: str, kind: str, extensions: tuple = None) -> Optional[str]:
+    """
+    Most recent artifact of a kind, found through the index of the registry instead of listing directory.
+    Records of artifacts that have been deleted since they were registered are dropped.
+
+    :param directory: Directory the artifacts are in
+    :param kind: Kind of artifact, e.g. trainedmodel
+    :param extensions: Extensions the artifact may have. Default is any
+    :return: Path to artifact or None if directory has no registry or it has no artifact of kind
+    """
+    extensions = tuple(extensions or ARTIFACT_KINDS[kind])
+    query = (
+        'SELECT name FROM artifacts WHERE kind = ? '
+        f'AND extension IN ({", ".join("?" * len(extensions))}) ORDER BY timestamp DESC, name DESC LIMIT 1'
+    )
+    with open_registry(directory, create=False) as connection:
+        while connection is not None:
+            row = connection.execute(query, (kind, *extensions)).fetchone()
+            if row is None:
+                return None
+            path = os.path.join(directory, row[0])
+            if os.path.exists(path):
+                return path
+            connection.execute('DELETE FROM artifacts WHERE name = ?', row)
+    return None
+
+
+def find_latest(directory: str, pattern: str) -> Optional[str]:
+    """
+    :param directory: Directory the artifacts are in
+    :param pattern: Pattern such as trainedmodel_*.pkl
+    :return: Path to latest artifact matching pattern or None if the registry cannot answer
+    """
+    match = ARTIFACT_PATTERN.fullmatch(pattern)
+    if match is None or match['extension'] not in ARTIFACT_KINDS.get(match['kind'], ()):
+        return None
+    return latest_artifact(directory, match['kind'], (match['extension'],))
+
+
+def _remove_artifact(directory: str, name: str) -> None:
+    stem = os.path.splitext(name)[0]
+    for f in os.listdir(directory):
+        if f == name or f.startswith(f'{stem}.'):
+            path = os.path.join(directory, f)
+            logger.info("Removing %s", path)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+
+def prune(directories: list, keep: int) -> list:
+    """
+    Retention policy. Keeps the latest keep artifacts of every kind in each directory and the artifacts
+    they were made from, and deletes older ones together with the files that share their stem.
+    Their records are dropped and the registries are compacted.
+
+    :param directories: Directories whose registries are pruned
+    :param keep: Number of versions of each kind to keep. At least 1
+    :return: Paths of the artifacts removed
+    """
+    if keep < 1:
+        raise ValueError(f"keep must be at least 1, not {keep}")
+
+    artifacts = {}
+    for directory in directories:
+        if os.path.isdir(directory):
+            with open_registry(directory) as connection:
+                scan_directory(connection, directory)
+                rows = connection.execute(
+                    'SELECT name, kind, parents FROM artifacts ORDER BY kind, timestamp DESC, name DESC'
+                ).fetchall()
+                # Records of files deleted by other means, e.g. by diagnostics, do not count as versions
+                missing = {name for name, _, _ in rows if not os.path.lexists(os.path.join(directory, name))}
+                connection.executemany('DELETE FROM artifacts WHERE name = ?', [(name,) for name in missing])
+                artifacts[directory] = [row for row in rows if row[0] not in missing]
+
+    kept = set()
+    protected = set()
+    for directory, rows in artifacts.items():
+        versions = {}
+        for name, kind, parents in rows:
+            versions[kind] = versions.get(kind, 0) + 1
+            if versions[kind] <= keep:
+                kept.add(normalise_path(os.path.join(directory, name)))
+                protected.update(json.loads(parents))
+
+    kept |= protected
+    removed = []
+    for directory, rows in artifacts.items():
+        names = [name for name, _, _ in rows if normalise_path(os.path.join(directory, name)) not in kept]
+        if not names:
+            continue
+        for name in names:
+            _remove_artifact(directory, name)
+            removed.append(os.path.join(directory, name))
+        with open_registry(directory) as connection:
+            connection.executemany('DELETE FROM artifacts WHERE name = ?', [(name,) for name in names])
+        with closing(sqlite3.connect(registry_path(directory), timeout=30)) as connection:
+            connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            connection.execute('VACUUM')
+    logger.info("Pruned %s artifacts from %s", len(removed), ', '.join(artifacts))
+    return removed
+
+
+def main():
+    with open('config.json', 'r') as f:
+        config = json.load(f)
+
+    keep = config.get('artifact_retention')
+    if not keep:
+        logger.info("artifact_retention is not set. Nothing to prune")
+        return
+    prune([config['output_model_path'], config['output_folder_path']], keep)
+
+
+if __name__ == '__main__':
+    # scripts.utils imports this module, so it is only imported when the registry is run on its own
+    from scripts.utils import configure_logging
+
+    configure_logging()
+    main()
@@ -1,15 +1,53 @@
 import json
+import logging
 import os
 
-import matplotlib.pyplot as plt
-from sklearn.metrics import confusion_matrix
-from sklearn.metrics import ConfusionMatrixDisplay
-
-from scripts.diagnostics import model_predictions
+from scripts.inference import load_deployed_model
+from scripts.scoring import evaluate_model
 from scripts.scoring import prepare_data
+from scripts.utils import configure_logging
+
+logger = logging.getLogger(__name__)
 
 
-def score_model(data: dict, model_dir: str, labels: list = None, output_dir: str = None) -> None:
+def plot_confusion_matrix(cm, labels: list, img_path: str) -> None:
+    """
+    Renders a Confusion Matrix to img_path with the headless Agg backend.
+    pyplot's global figures are not used, so it is safe to call from a background thread
+    :param cm: Confusion counts
+    :param labels: Labels for Confusion Matrix
+    :param img_path: Path of image
+    :return: None
+    """
+    # matplotlib is only imported when a report is drawn
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from sklearn.metrics import ConfusionMatrixDisplay
+
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    ConfusionMatrixDisplay(cm, display_labels=labels).plot(ax=figure.subplots())
+    logger.info("Saving Confusion Matrix image to %s", img_path)
+    figure.savefig(img_path)
+
+
+def report_evaluation(evaluation: dict, labels: list = None, output_dir: str = None) -> None:
+    """
+    Saves the Confusion Matrix of an evaluation made by scripts.scoring.evaluate_model to output_dir
+    """
+    cm = evaluation['confusion_matrix']
+    logger.info('Confusion Matrix\n%s', cm)
+    plot_confusion_matrix(cm, labels, os.path.join(output_dir, "confusion_matrix.png"))
+
+
+def score_model(
+        data: dict,
+        model_dir: str = None,
+        labels: list = None,
+        output_dir: str = None,
+        model=None,
+        evaluation: dict = None
+) -> None:
     """
     Makes predictions on test data and saves Confusion Matrix to output_dir
     :param data: Dataset to be predicted upon.
@@ -17,19 +55,14 @@ def score_model(data: dict, model_dir: str, labels: list = None, output_dir: str
     :param model_dir: Path to dir containing model
     :param labels: Labels for Confusion Matrix
     :param output_dir: Directory where Confusion Matrix plot is saved to
+    :param model: Fitted model. Is used if passed else model is loaded from model_dir
+    :param evaluation: Evaluation of the model made while scoring it. If passed, no predictions are made
     :return: None
     """
-    X = data['test']['X']
-    predictions = model_predictions(X, model_path=model_dir)
-    cm = confusion_matrix(data['test']['y'], predictions)
-    print('Confusion Matrix', cm, sep='\n')
-
-    cm_display = ConfusionMatrixDisplay(cm, display_labels=labels)
-    cm_display.plot()
-
-    img_path = os.path.join(output_dir, "confusion_matrix.png")
-    print(f"Saving Confusion Matrix image to {img_path}")
-    plt.savefig(img_path)
+    if evaluation is None:
+        assert any([model, model_dir]), "model or model_dir must be passed into function"
+        evaluation = evaluate_model(data, model or load_deployed_model(model_dir))
+    report_evaluation(evaluation, labels=labels, output_dir=output_dir)
 
 
 def main(model_dir: str = None, output_dir: str = None):
@@ -49,4 +82,5 @@ def main(model_dir: str = None, output_dir: str = None):
 
 
 if __name__ == '__main__':
+    configure_logging()
     main()
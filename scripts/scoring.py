@@ -1,70 +1,141 @@
+import logging
 import os
 import glob
 import json
 import time
+from typing import TYPE_CHECKING
 
-import pandas as pd
-from sklearn.linear_model import LogisticRegression
-from sklearn.metrics import classification_report
-from sklearn.metrics import f1_score
+import numpy as np
 
+from scripts.datastore import read_csv_files
+from scripts.inference import load_scorer
+from scripts.registry import register
+from scripts.utils import configure_logging
 from scripts.utils import get_latest_file
 from scripts.utils import load_model
 
+logger = logging.getLogger(__name__)
+
+# scikit-learn's metrics are imported when a model is evaluated, so that prepare_data can be used without them
+if TYPE_CHECKING:
+    from sklearn.linear_model import LogisticRegression
+
 
 def prepare_data(dataset_path: str, dropped_columns: list = None) -> dict:
     """
     Prepares test dataset for use.
+    CSV files are read concurrently through a columnar copy so dropped columns are never parsed.
     :param dataset_path: Directory contained CSV dataset(s)
     :param dropped_columns: List of columns to be dropped from DataFrame
     :return:
     """
     dataset_list = glob.glob(f"{dataset_path}/*.csv")
-    print(f"Found {len(dataset_list)} files. Creating dataframe")
+    logger.info("Found %s files. Creating dataframe", len(dataset_list))
 
-    df = pd.concat(map(pd.read_csv, dataset_list))
-    if dropped_columns:
-        df.drop(dropped_columns, axis=1, inplace=True)
-    print(f"Test dataset is of shape: {df.shape}")
+    df = read_csv_files(dataset_list, dropped_columns=dropped_columns, cached=True)
+    logger.info("Test dataset is of shape: %s", df.shape)
 
     y = df.pop("exited")
     data = {"test": {"X": df, "y": y}}
     return data
 
 
+def evaluate_model(data: dict, model: 'LogisticRegression') -> dict:
+    """
+    Makes predictions on test data once. The predictions and confusion counts are kept with the F1-Score
+    so that reporting can use them without predicting again
+    :param data: Data for which predictions are to be made. Should have form: {'test': {'X': <Xdf>, 'y': <y_df>}}
+    :param model: Trained LogisticRegression model or its LinearScorer
+    :return: {'predictions': <array>, 'confusion_matrix': <2x2 array of counts>, 'f1_score': <float>}
+    """
+    from sklearn.metrics import classification_report
+    from sklearn.metrics import confusion_matrix
+    from sklearn.metrics import f1_score
+
+    y = np.asarray(data["test"]["y"])
+    predictions = np.asarray(model.predict(data["test"]["X"]))
+    logger.info(classification_report(y, predictions))
+
+    f1score = float(f1_score(y, predictions))
+    logger.info("Model F1-Score: %s", f1score)
+    return {
+        'predictions': predictions,
+        'confusion_matrix': confusion_matrix(y, predictions, labels=[0, 1]),
+        'f1_score': f1score
+    }
+
+
+def evaluation_path(metric_file_path: str) -> str:
+    """
+    Path of the evaluation stored next to a score, e.g. latestscore_*.npz for latestscore_*.txt
+    """
+    return os.path.splitext(metric_file_path)[0] + '.npz'
+
+
+def save_evaluation(evaluation: dict, path: str) -> None:
+    logger.info("Writing evaluation to %s", path)
+    np.savez(
+        path,
+        predictions=evaluation['predictions'],
+        confusion_matrix=evaluation['confusion_matrix'],
+        f1_score=evaluation['f1_score']
+    )
+
+
+def load_evaluation(path: str):
+    """
+    :return: Evaluation saved by save_evaluation or None if path does not exist
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as f:
+        return {
+            'predictions': f['predictions'],
+            'confusion_matrix': f['confusion_matrix'],
+            'f1_score': float(f['f1_score'])
+        }
+
+
 def score_model(
         data: dict,
-        model: LogisticRegression,
+        model: 'LogisticRegression',
         output_to_file: bool = True,
-        metric_output_dir: str = None
+        metric_output_dir: str = None,
+        model_file: str = None
 ) -> float:
     """
     Use input model to make predictions on test data and calculate F1-Score
     :param data: Data for which predictions are to be mad.e
-    :param model: Trained LogisticRegression model
+    :param model: Trained LogisticRegression model or its LinearScorer
     :param output_to_file: Whether to write F1-Score to file
     :param metric_output_dir: Directory where F1-Score is written to
-    :return: None
+    :param model_file: File model was loaded from. It is recorded as the score's parent in the registry
+    :return: F1-Score
     """
-    predictions = model.predict(data["test"]["X"])
-    print(classification_report(data["test"]["y"], predictions))
-
-    f1score = f1_score(data["test"]["y"], predictions)
-    print(f"Model F1-Score: {f1score}")
+    evaluation = evaluate_model(data, model)
+    f1score = evaluation['f1_score']
 
     if output_to_file:
         if not metric_output_dir:
             raise Exception("metric_output_dir should not be None")
-        os.makedirs(metric_output_dir, exist_ok=True)
-        metric_file_path = os.path.join(
-            metric_output_dir, f"latestscore_{time.strftime('%y%m%d%H%M%S')}.txt"
-        )
-        with open(metric_file_path, "w") as f:
-            print(f"Writing F1-Score to {metric_file_path}")
-            f.write(str(f1score))
+        metric_file_path = new_score_path(metric_output_dir)
+        write_score(f1score, metric_file_path, parents=[model_file] if model_file else [])
+        save_evaluation(evaluation, evaluation_path(metric_file_path))
     return f1score
 
 
+def new_score_path(metric_output_dir: str) -> str:
+    return os.path.join(metric_output_dir, f"latestscore_{time.strftime('%y%m%d%H%M%S')}.txt")
+
+
+def write_score(f1score: float, metric_file_path: str, parents: list = None) -> None:
+    os.makedirs(os.path.dirname(metric_file_path) or '.', exist_ok=True)
+    with open(metric_file_path, "w") as f:
+        logger.info("Writing F1-Score to %s", metric_file_path)
+        f.write(str(f1score))
+    register(metric_file_path, parents=parents)
+
+
 def main():
     with open('config.json', 'r') as f:
         config = json.load(f)
@@ -73,13 +144,16 @@ def main():
     test_data_path = config['test_data_path']
 
     data = prepare_data(test_data_path, dropped_columns=["corporation"])
-    model = load_model(model_path)
+    model = load_scorer(model_path) or load_model(model_path)
 
     if model is None:
         raise Exception(f"No model found in {model_path}")
 
-    return score_model(data, model, metric_output_dir=model_path)
+    return score_model(
+        data, model, metric_output_dir=model_path, model_file=get_latest_file(model_path, 'trainedmodel_*.pkl')
+    )
 
 
 if __name__ == '__main__':
+    configure_logging()
     main()
@@ -0,0 +1,125 @@
+import gc
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+
+from flask import Flask
+from werkzeug.serving import make_server
+
+from scripts.app import create_app
+from scripts.utils import configure_logging
+
+logger = logging.getLogger(__name__)
+
+
+def run_worker(app: Flask, sock: socket.socket) -> None:
+    """
+    Serves requests accepted on a socket shared with the other workers
+    :param app: Application created before the worker was forked
+    :param sock: Listening socket
+    :return: None
+    """
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    app.extensions['adras'].start_background_tasks()
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+    logger.info("Worker %s serving on http://%s:%s", os.getpid(), host, port)
+    server.serve_forever()
+
+
+def serve(app: Flask, host: str = '0.0.0.0', port: int = 8000, workers: int = None) -> None:
+    """
+    Forks workers that serve app from one listening socket.
+    The model and data are loaded before forking so workers share them copy-on-write.
+    Workers that exit are replaced until the server receives SIGINT or SIGTERM.
+
+    :param app: Application created with scripts.app.create_app(start_background_tasks=False)
+    :param host: Host to listen on
+    :param port: Port to listen on
+    :param workers: Number of worker processes. Default is the number of CPUs
+    :return: None
+    """
+    workers = workers or os.cpu_count() or 1
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(socket.SOMAXCONN)
+    sock.set_inheritable(True)
+
+    # Objects created so far are not tracked by the collector in the workers,
+    # which would otherwise write to their pages and undo copy-on-write sharing
+    gc.freeze()
+
+    children = set()
+    shutting_down = False
+
+    def spawn() -> None:
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(app, sock)
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    def shutdown(*_) -> None:
+        nonlocal shutting_down
+        shutting_down = True
+        for child in children:
+            try:
+                os.kill(child, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    logger.info("Starting %s workers on http://%s:%s", workers, host, port)
+    for _ in range(workers):
+        spawn()
+
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not shutting_down:
+            logger.info("Worker %s exited. Starting a new worker", pid)
+            spawn()
+    sock.close()
+
+
+def main():
+    with open('config.json', 'r') as f:
+        config = json.load(f)
+
+    configure_logging(config.get('log_level'))
+    # Workers share diagnostic jobs through files so any worker can answer a poll
+    temporary_job_store = None
+    if not config.get('job_store_path'):
+        temporary_job_store = config['job_store_path'] = tempfile.mkdtemp(prefix='adras-jobs-')
+    try:
+        app = create_app(config, start_background_tasks=False)
+        serve(
+            app,
+            host=config.get('server_host', '0.0.0.0'),
+            port=config.get('server_port', 8000),
+            workers=config.get('server_workers')
+        )
+    finally:
+        # Only the parent gets here once its workers have exited. Workers leave through os._exit
+        if temporary_job_store:
+            shutil.rmtree(temporary_job_store, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
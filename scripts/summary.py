@@ -0,0 +1,201 @@
+import json
+import logging
+import os
+
+import numpy as np
+from pandas import DataFrame
+from pandas.api.types import is_numeric_dtype
+
+from scripts.datastore import read_dataset
+from scripts.datastore import sidecar_path
+
+logger = logging.getLogger(__name__)
+
+
+class ColumnStats:
+    """
+    Mergeable running statistics of a numeric column.
+        - Mean and variance are updated with Welford's/Chan's method
+        - The median is read from a sketch of at most max_centroids weighted centroids.
+        It is exact while the column has at most max_centroids distinct values.
+    """
+    def __init__(self, max_centroids: int = 512):
+        self.max_centroids = max_centroids
+        self.count = 0
+        self.missing = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.centroids = np.empty(0, dtype=np.float64)
+        self.weights = np.empty(0, dtype=np.float64)
+
+    def update(self, values: np.ndarray) -> None:
+        values = np.asarray(values, dtype=np.float64)
+        is_missing = np.isnan(values)
+        values = values[~is_missing]
+        self.missing += int(is_missing.sum())
+        if not values.size:
+            return
+
+        centroids, weights = np.unique(values, return_counts=True)
+        self._merge(values.size, values.mean(), ((values - values.mean()) ** 2).sum(), centroids, weights)
+
+    def merge(self, other: 'ColumnStats') -> None:
+        self.missing += other.missing
+        if other.count:
+            self._merge(other.count, other.mean, other.m2, other.centroids, other.weights)
+
+    def _merge(self, count: int, mean: float, m2: float, centroids: np.ndarray, weights: np.ndarray) -> None:
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+        centroids = np.concatenate([self.centroids, centroids])
+        weights = np.concatenate([self.weights, weights])
+        order = np.argsort(centroids, kind='mergesort')
+        centroids, weights = centroids[order], weights[order]
+        # Equal centroids are combined first so that the sketch stays exact for as long as possible
+        unique_centroids, positions = np.unique(centroids, return_inverse=True)
+        weights = np.bincount(positions, weights=weights)
+        self.centroids, self.weights = unique_centroids, weights
+        if self.centroids.size > self.max_centroids:
+            self._compress()
+
+    def _compress(self) -> None:
+        cumulative = np.cumsum(self.weights) - self.weights / 2
+        bins = np.minimum(
+            (cumulative / self.weights.sum() * self.max_centroids).astype(np.intp), self.max_centroids - 1
+        )
+        weights = np.bincount(bins, weights=self.weights)
+        centroids = np.bincount(bins, weights=self.weights * self.centroids)
+        non_empty = weights > 0
+        self.centroids, self.weights = centroids[non_empty] / weights[non_empty], weights[non_empty]
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return float('nan')
+        cumulative = np.cumsum(self.weights)
+        position = q * (cumulative[-1] - 1)
+        lower, upper = np.floor(position), np.ceil(position)
+        lower_value, upper_value = self.centroids[
+            np.minimum(np.searchsorted(cumulative, [lower + 1, upper + 1]), self.centroids.size - 1)
+        ]
+        return float(lower_value + (upper_value - lower_value) * (position - lower))
+
+    def median(self) -> float:
+        return self.quantile(0.5)
+
+    def cdf(self, values: np.ndarray) -> np.ndarray:
+        """
+        :param values: Points at which the empirical distribution function is evaluated
+        :return: Fraction of non-missing values less than or equal to each point
+        """
+        if not self.count:
+            return np.full(np.shape(values), np.nan)
+        cumulative = np.concatenate([[0.0], np.cumsum(self.weights)])
+        return cumulative[np.searchsorted(self.centroids, values, side='right')] / cumulative[-1]
+
+    def std(self) -> float:
+        # Sample standard deviation like pandas.DataFrame.std
+        return float(np.sqrt(self.m2 / (self.count - 1))) if self.count > 1 else float('nan')
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'missing': self.missing,
+            'mean': self.mean,
+            'm2': self.m2,
+            'centroids': self.centroids.tolist(),
+            'weights': self.weights.tolist(),
+            'max_centroids': self.max_centroids
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'ColumnStats':
+        stats = cls(max_centroids=d['max_centroids'])
+        stats.count, stats.missing, stats.mean, stats.m2 = d['count'], d['missing'], d['mean'], d['m2']
+        stats.centroids = np.asarray(d['centroids'], dtype=np.float64)
+        stats.weights = np.asarray(d['weights'], dtype=np.float64)
+        return stats
+
+
+class DatasetStats:
+    """
+    Running statistics of a dataset that are updated as rows are ingested.
+    Every column has a missing value count. Numeric columns also have a ColumnStats.
+    """
+    def __init__(self):
+        self.n_rows = 0
+        self.missing = {}
+        self.numeric = {}
+
+    def update(self, df: DataFrame) -> None:
+        self.n_rows += df.shape[0]
+        for column, n_missing in df.isna().sum().items():
+            self.missing[column] = self.missing.get(column, 0) + int(n_missing)
+        for column in df.columns:
+            if is_numeric_dtype(df[column]):
+                self.numeric.setdefault(column, ColumnStats()).update(df[column].to_numpy())
+
+    def summary(self, columns: list) -> list:
+        """
+        Same layout as data.agg(["mean", "median", "std"]).values.tolist()
+
+        :param columns: Numeric columns to be summarised
+        :return: [[<means>], [<medians>], [<standard deviations>]]
+        """
+        stats = [self.numeric[c] for c in columns]
+        return [
+            [s.mean if s.count else float('nan') for s in stats],
+            [s.median() for s in stats],
+            [s.std() for s in stats]
+        ]
+
+    def missing_fractions(self, columns: list) -> list:
+        return [self.missing.get(c, 0) / self.n_rows if self.n_rows else float('nan') for c in columns]
+
+    def save(self, path: str) -> None:
+        tmp_path = f'{path}.tmp{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'n_rows': self.n_rows,
+                'missing': self.missing,
+                'numeric': {c: s.to_dict() for c, s in self.numeric.items()}
+            }, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'DatasetStats':
+        with open(path, 'r') as f:
+            d = json.load(f)
+        stats = cls()
+        stats.n_rows, stats.missing = d['n_rows'], d['missing']
+        stats.numeric = {c: ColumnStats.from_dict(s) for c, s in d['numeric'].items()}
+        return stats
+
+
+def stats_path(dataset_path: str) -> str:
+    return sidecar_path(dataset_path, 'stats.json')
+
+
+def load_stats(dataset_path: str, compute: bool = True):
+    """
+    Loads the running statistics stored next to a dataset
+
+    :param dataset_path: Path to dataset
+    :param compute: Compute the statistics from the dataset if they have not been stored
+    :return: DatasetStats or None if they have not been stored and compute is False
+    """
+    if os.path.exists(stats_path(dataset_path)):
+        return DatasetStats.load(stats_path(dataset_path))
+    if not compute:
+        return None
+    logger.info("No summary statistics found for %s. Computing them from the dataset", dataset_path)
+    stats = DatasetStats()
+    stats.update(read_dataset(dataset_path))
+    return stats
+
+
+def save_stats(stats: DatasetStats, dataset_path: str) -> None:
+    stats.save(stats_path(dataset_path))
@@ -1,16 +1,54 @@
-import glob
+import copy
 import json
+import logging
 import os
 import pickle
+import tempfile
 import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from itertools import repeat
+from operator import itemgetter
+from typing import TYPE_CHECKING
 from typing import Union
 
-import pandas as pd
+import numpy as np
 from pandas import DataFrame
-from sklearn.linear_model import LogisticRegression
-from sklearn.metrics import classification_report
-from sklearn.metrics import f1_score
-from sklearn.model_selection import train_test_split
+
+from scripts.datastore import get_latest_dataset
+from scripts.datastore import read_dataset
+from scripts.drift import build_profile
+from scripts.drift import reference_profile_path
+from scripts.drift import save_profile
+from scripts.inference import get_feature_names
+from scripts.inference import LinearScorer
+from scripts.registry import register
+from scripts.summary import load_stats
+from scripts.utils import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# scikit-learn is imported by the functions that fit models, so that the API and diagnostics
+# can import prepare_dataset without it
+if TYPE_CHECKING:
+    from sklearn.linear_model import LogisticRegression
+
+
+MODEL_PARAMS = dict(
+    C=1.0,
+    class_weight=None,
+    dual=False,
+    fit_intercept=True,
+    intercept_scaling=1,
+    l1_ratio=None,
+    max_iter=100,
+    multi_class='auto',
+    n_jobs=None,
+    penalty='l2',
+    tol=0.0001,
+    verbose=0,
+    warm_start=False
+)
 
 
 def prepare_dataset(
@@ -20,10 +58,11 @@ def prepare_dataset(
         dropped_columns: list = None
 ) -> Union[dict, DataFrame]:
     """
-    Reads the most recent dataset 'finaldata_*.csv' from
-    the dataset_path and prepares it for training
+    Reads the most recent dataset 'finaldata_*' from
+    the dataset_path and prepares it for training.
+    Dropped columns are not read from the dataset.
 
-    :param dataset_path: Directory containing CSV datasets named 'finaldata_*.csv'
+    :param dataset_path: Directory containing datasets named 'finaldata_*.csv' or 'finaldata_*.cols'
     :param val_size: test_size to use in train_test_split when creating validation data
     :param create_val_data:
     :param dropped_columns: Columns to drop from dataset
@@ -35,67 +74,347 @@ def prepare_dataset(
         }
     else DataFrame
     """
-    dataset_list = glob.glob(f"{dataset_path}/finaldata_*.csv")
-    dataset_list.sort()
-    dataset = pd.read_csv(dataset_list[-1])     # Most recent dataset is used.
-    print(f"DataFrame was successfully created from {dataset_list[-1]}")
-    dataset.drop(dropped_columns, axis=1, inplace=True)
-    print(f"Dropped columns: {dropped_columns}")
+    latest_dataset = get_latest_dataset(dataset_path)     # Most recent dataset is used.
+    dataset = read_dataset(latest_dataset, dropped_columns=dropped_columns)
+    logger.info("DataFrame was successfully created from %s", latest_dataset)
+    logger.info("Dropped columns: %s", dropped_columns)
 
     if create_val_data:
-        x_train, x_val = train_test_split(dataset, test_size=val_size, random_state=42)
-        y_train, y_val = x_train.pop("exited"), x_val.pop("exited")
-        data = {"training": {"X": x_train, "y": y_train}, "val": {"X": x_val, "y": y_val}}
-        print(f"{val_size*100}% of dataset is held out as validation data")
-        return data
+        return split_dataset(dataset, val_size=val_size)
     return dataset
 
 
-def train_model(data: dict, model_dir: str) -> None:
+def split_dataset(dataset: DataFrame, val_size: float = 0.1) -> dict:
     """
-    Fits model on input data, calculates performance metrics and
-    dumps model to dir
-    :param data: Data dictionary containing
-    :param model_dir: Path to dir containing model
-    :return: None
+    Holds out val_size of dataset as validation data
+    :param dataset: DataFrame with an 'exited' column
+    :param val_size: test_size to use in train_test_split
+    :return: {'training: {'X': <x_train_df>: 'y': <y_train_df>}, 'val': {'X': <x_val_df', 'y': <y_val_df>}}
     """
-    model = LogisticRegression(
-        C=1.0,
-        class_weight=None,
-        dual=False,
-        fit_intercept=True,
-        intercept_scaling=1,
-        l1_ratio=None,
-        max_iter=100,
-        multi_class='auto',
-        n_jobs=None,
-        penalty='l2',
-        tol=0.0001,
-        verbose=0,
-        warm_start=False
-    )
-    print("Fitting model...")
+    from sklearn.model_selection import train_test_split
+
+    x_train, x_val = train_test_split(dataset, test_size=val_size, random_state=42)
+    y_train, y_val = x_train.pop("exited"), x_val.pop("exited")
+    logger.info("%s%% of dataset is held out as validation data", val_size * 100)
+    return {"training": {"X": x_train, "y": y_train}, "val": {"X": x_val, "y": y_val}}
+
+
+def fit_model(data: dict, **params) -> 'LogisticRegression':
+    """
+    Fits model on training data and prints its performance on validation data
+    :param data: Data dictionary returned by split_dataset
+    :param params: LogisticRegression parameters that differ from MODEL_PARAMS
+    :return: Fitted model
+    """
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.metrics import classification_report
+    from sklearn.metrics import f1_score
+
+    model = LogisticRegression(**dict(MODEL_PARAMS, **params))
+    logger.info("Fitting model...")
     model.fit(data["training"]["X"], data["training"]["y"])
 
     accuracy = model.score(data["val"]["X"], data["val"]["y"])
-    print(f"Model Accuracy: {accuracy}")
+    logger.info("Model Accuracy: %s", accuracy)
 
     predictions = model.predict(data["val"]["X"])
     f1score = f1_score(data["val"]["y"], predictions)
-    print(f"Model F1-Score: {f1score}")
+    logger.info("Model F1-Score: %s", f1score)
+
+    logger.info(classification_report(data["val"]["y"], predictions))
+    return model
+
 
-    print(classification_report(data["val"]["y"], predictions))
+def candidate_params(grid: dict) -> list:
+    """
+    :param grid: Values to try for LogisticRegression parameters,
+    e.g. {'C': [0.1, 1.0], 'class_weight': [None, 'balanced'], 'solver': ['lbfgs', 'liblinear']}
+    :return: Parameters of every combination of values
+    """
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in product(*(grid[name] for name in names))]
 
-    os.makedirs(model_dir, exist_ok=True)
-    model_path = os.path.join(model_dir, f"trainedmodel_{time.strftime('%y%m%d%H%M%S')}.pkl")
-    print(f"Persisting fitted model to {model_path}...")
+
+def _fit_candidate(data_dir: str, n_train: int, params: dict) -> tuple:
+    # Runs in a worker process. The arrays are memory-mapped, so all workers share one copy in the page cache
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.metrics import f1_score
+
+    X = np.load(os.path.join(data_dir, 'X.npy'), mmap_mode='r')
+    y = np.load(os.path.join(data_dir, 'y.npy'), mmap_mode='r')
+    try:
+        model = LogisticRegression(**dict(MODEL_PARAMS, **params)).fit(X[:n_train], y[:n_train])
+    except ValueError as e:
+        logger.info("Candidate %s failed: %s", params, e)
+        return params, None, None
+    return params, model, f1_score(y[n_train:], model.predict(X[n_train:]))
+
+
+def search_models(data: dict, grid: dict, n_workers: int = None) -> 'LogisticRegression':
+    """
+    Fits a candidate model for every combination of parameters in grid in a pool of processes
+    and returns the candidate with the best F1-Score on the validation data.
+    Training and validation data are written once to memory-mapped files that every worker reads
+    instead of each worker receiving its own pickled copy.
+
+    :param data: Data dictionary returned by split_dataset
+    :param grid: See candidate_params
+    :param n_workers: Number of processes. Default is one per candidate, at most the number of CPUs
+    :return: Best model
+    """
+    from sklearn.metrics import classification_report
+
+    candidates = candidate_params(grid)
+    feature_names = list(data["training"]["X"].columns)
+    n_train = data["training"]["X"].shape[0]
+    n_workers = min(n_workers or os.cpu_count() or 1, len(candidates))
+
+    with tempfile.TemporaryDirectory(prefix='adras-search-') as data_dir:
+        np.save(os.path.join(data_dir, 'X.npy'), np.concatenate([
+            data["training"]["X"].to_numpy(np.float64), data["val"]["X"].to_numpy(np.float64)
+        ]))
+        np.save(os.path.join(data_dir, 'y.npy'), np.concatenate([
+            data["training"]["y"].to_numpy(), data["val"]["y"].to_numpy()
+        ]))
+        logger.info("Fitting %s candidate models in %s processes...", len(candidates), n_workers)
+        if n_workers == 1:
+            results = [_fit_candidate(data_dir, n_train, params) for params in candidates]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                results = list(executor.map(_fit_candidate, repeat(data_dir), repeat(n_train), candidates))
+
+    for params, _, f1score in results:
+        logger.info("Candidate %s: validation F1-Score %s", params, f1score)
+    fitted = [result for result in results if result[1] is not None]
+    if not fitted:
+        raise ValueError("No candidate model could be fitted")
+    params, model, f1score = max(fitted, key=itemgetter(2))
+    # Candidates are fitted on arrays. The best one gets the column names a fit on the DataFrame would have given it
+    model.feature_names_in_ = np.asarray(feature_names, dtype=object)
+    logger.info("Best candidate is %s with validation F1-Score %s", params, f1score)
+    logger.info(classification_report(data["val"]["y"], model.predict(data["val"]["X"])))
+    return model
+
+
+def fit_best_model(data: dict, grid: dict = None, n_workers: int = None) -> 'LogisticRegression':
+    """
+    Fits the model with MODEL_PARAMS or, if a grid of parameters is passed, the best candidate. See search_models
+    The log loss derivatives of the training rows are kept with a binary model so that it can be updated later.
+    See update_model
+    """
+    if not grid or len(candidate_params(grid)) == 1:
+        model = fit_model(data, **(candidate_params(grid)[0] if grid else {}))
+    else:
+        model = search_models(data, grid, n_workers=n_workers)
+    if len(model.classes_) == 2:
+        model.loss_gradient_, model.loss_hessian_ = log_loss_derivatives(
+            model, data["training"]["X"], data["training"]["y"]
+        )
+    return model
+
+
+def log_loss_derivatives(model: 'LogisticRegression', X: DataFrame, y) -> tuple:
+    """
+    Gradient and Hessian of the log loss of a binary model summed over rows, with respect to [intercept, *coef].
+    Sums over separate batches of rows add up, so they summarise the rows a model has been trained on.
+
+    :param model: Fitted binary model
+    :param X: Rows
+    :param y: Labels of rows
+    :return: (<array of shape (n_features + 1,)>, <array of shape (n_features + 1, n_features + 1)>)
+    """
+    A = np.column_stack([np.ones(len(X)), np.asarray(X, dtype=np.float64)])
+    y = (np.asarray(y) == model.classes_[1]).astype(np.float64)
+    p = 1.0 / (1.0 + np.exp(-(A @ np.concatenate([model.intercept_, model.coef_[0]]))))
+    return A.T @ (p - y), (A.T * (p * (1 - p))) @ A
+
+
+def update_model(
+        model: 'LogisticRegression',
+        X: DataFrame,
+        y,
+        max_iter: int = 10,
+        tol: float = 1e-8
+) -> 'LogisticRegression':
+    """
+    Continues training a fitted binary LogisticRegression on new rows only.
+    The rows the model has been trained on are summarised by a quadratic approximation of their loss around the
+    current coefficients, built from the gradient and Hessian kept in the model's loss_gradient_ and loss_hessian_.
+    A few Newton steps then minimise the same L2-regularised log loss as a fit on all rows would, so the time
+    taken depends on the number of new rows, not on the size of the dataset the model was fitted on.
+    The derivatives of the new rows are added to the model's, so later updates summarise them as well.
+
+    :param model: Fitted model. It is not changed
+    :param X: New rows
+    :param y: Labels of new rows
+    :param max_iter: Maximum number of Newton steps
+    :param tol: Stop once the largest change of a coefficient in a step is below tol
+    :return: Updated copy of model. Its n_incremental_updates_ counts updates since the last full fit
+    :raises ValueError: If model is not binary or has no loss derivatives. See fit_best_model
+    """
+    if len(model.classes_) != 2:
+        raise ValueError("Only binary models can be updated incrementally")
+    if getattr(model, 'loss_hessian_', None) is None:
+        raise ValueError("Model has no loss derivatives of the rows it was fitted on")
+    model = copy.deepcopy(model)
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y)
+
+    n_new_rows = X.shape[0]
+    if n_new_rows:
+        # Newton steps are taken on standardised features with an intercept column and mapped back afterwards.
+        # [intercept, *coef] = transform @ theta
+        mean = X.mean(axis=0)
+        scale = X.std(axis=0)
+        scale[scale == 0] = 1.0
+        transform = np.eye(mean.size + 1)
+        transform[0, 1:] = -mean / scale
+        transform[1:, 1:] = np.diag(1.0 / scale)
+        Z = np.column_stack([np.ones(n_new_rows), (X - mean) / scale])
+        labels = (y == model.classes_[1]).astype(np.float64)
+        theta_0 = np.concatenate([
+            [model.intercept_[0] + model.coef_[0] @ mean], model.coef_[0] * scale
+        ])
+        # LogisticRegression minimises sum(log loss) + ||coef||^2 / (2C). The intercept is not penalised
+        penalty = np.concatenate([[0.0], 1.0 / (model.C * scale ** 2)])
+        old_gradient = transform.T @ model.loss_gradient_
+        old_hessian = transform.T @ model.loss_hessian_ @ transform
+
+        theta = theta_0.copy()
+        for _ in range(max_iter):
+            p = 1.0 / (1.0 + np.exp(-(Z @ theta)))
+            gradient = Z.T @ (p - labels) + old_gradient + old_hessian @ (theta - theta_0) + penalty * theta
+            hessian = (Z.T * (p * (1 - p))) @ Z + old_hessian + np.diag(penalty)
+            step = np.linalg.solve(hessian + 1e-12 * np.eye(theta.size), gradient)
+            theta -= step
+            if np.abs(step).max() < tol:
+                break
+
+        model.coef_ = (theta[1:] / scale)[np.newaxis, :]
+        model.intercept_ = np.array([theta[0] - model.coef_[0] @ mean])
+        # The derivatives of the old rows are moved to the new coefficients along their quadratic approximation
+        new_gradient, new_hessian = log_loss_derivatives(model, X, y)
+        moved_gradient = model.loss_gradient_ + model.loss_hessian_ @ (transform @ (theta - theta_0))
+        model.loss_gradient_ = moved_gradient + new_gradient
+        model.loss_hessian_ = model.loss_hessian_ + new_hessian
+
+    model.n_incremental_updates_ = getattr(model, 'n_incremental_updates_', 0) + 1
+    logger.info("Updated model on %s new rows. %s incremental updates since the last full fit",
+                n_new_rows, model.n_incremental_updates_)
+    return model
+
+
+def set_dataset_state(model: 'LogisticRegression', dataset_path: str, n_rows: int) -> None:
+    """
+    Records that model has been trained on the first n_rows rows of dataset_path.
+    Rows are only ever appended to a dataset, so the rows after them are the ones the model has not learned yet.
+    See warm_start_model
+    """
+    model.dataset_state_ = {'dataset': os.path.basename(dataset_path), 'n_rows': int(n_rows)}
+
+
+def warm_start_model(
+        model: 'LogisticRegression',
+        dataset_path: str,
+        n_rows: int,
+        full_refit_interval: int = 10
+) -> 'LogisticRegression':
+    """
+    Updates a fitted model on all rows appended to its dataset since it was trained unless a full fit is due.
+    Rows ingested by runs whose model was not deployed are learned as well. See update_model
+
+    :param model: Deployed model or None
+    :param dataset_path: Dataset rows have been appended to
+    :param n_rows: Number of rows in the dataset
+    :param full_refit_interval: Number of incremental updates after which the model is fitted on the whole dataset
+    :return: Updated model or None if the model should be fitted on the whole dataset
+    """
+    if model is None:
+        logger.info("No model to update. Fitting on the whole dataset")
+        return None
+    if getattr(model, 'n_incremental_updates_', 0) >= full_refit_interval:
+        logger.info("Model has been updated %s times since the last full fit. Fitting on the whole dataset",
+                    full_refit_interval)
+        return None
+    if len(model.classes_) != 2:
+        logger.info("Only binary models can be updated incrementally. Fitting on the whole dataset")
+        return None
+    if getattr(model, 'loss_hessian_', None) is None:
+        # Models fitted before their loss derivatives were kept cannot summarise the rows they were fitted on
+        logger.info("Model has no loss derivatives of the rows it was fitted on. Fitting on the whole dataset")
+        return None
+
+    state = getattr(model, 'dataset_state_', None)
+    if state is None or state['dataset'] != os.path.basename(dataset_path) or state['n_rows'] > n_rows:
+        logger.info("Model was not trained on earlier rows of %s. Fitting on the whole dataset", dataset_path)
+        return None
+
+    feature_names = get_feature_names(model)
+    new_rows = read_dataset(dataset_path, columns=feature_names + ["exited"], start=state['n_rows'], stop=n_rows)
+    if not set(feature_names + ["exited"]).issubset(new_rows.columns):
+        logger.info("New rows do not have the model's features. Fitting on the whole dataset")
+        return None
+    model = update_model(model, new_rows[feature_names], new_rows["exited"])
+    set_dataset_state(model, dataset_path, n_rows)
+    return model
+
+
+def save_model(model: 'LogisticRegression', model_path: str, feature_names: list, parents: list = None) -> None:
+    """
+    Dumps model to model_path and registers it. The model's coefficients are also exported
+    next to it as a LinearScorer for sklearn-free inference.
+    :param model: Fitted model
+    :param model_path: Path of pkl file
+    :param feature_names: Columns the model was fitted on
+    :param parents: Paths of the artifacts the model was made from. See scripts.registry.register
+    :return: None
+    """
+    os.makedirs(os.path.dirname(model_path) or '.', exist_ok=True)
+    logger.info("Persisting fitted model to %s...", model_path)
     with open(model_path, "wb") as modelfile:
         pickle.dump(model, modelfile)
 
+    scorer_path = os.path.splitext(model_path)[0] + ".npz"
+    logger.info("Exporting model coefficients to %s...", scorer_path)
+    LinearScorer.from_model(model, feature_names=feature_names).save(scorer_path)
+    register(model_path, parents=parents)
+
 
-def main():
-    with open('config.json', 'r') as f:
-        config = json.load(f)
+def new_model_path(model_dir: str) -> str:
+    return os.path.join(model_dir, f"trainedmodel_{time.strftime('%y%m%d%H%M%S')}.pkl")
+
+
+def train_model(
+        data: dict, model_dir: str, grid: dict = None, n_workers: int = None, dataset_path: str = None
+) -> str:
+    """
+    Fits model on input data, calculates performance metrics and
+    dumps model to dir. See fit_best_model and save_model
+    :param data: Data dictionary containing
+    :param model_dir: Path to dir containing model
+    :param grid: Parameters of candidate models. See search_models
+    :param n_workers: Number of processes fitting candidate models
+    :param dataset_path: Dataset data was read from. It is recorded as the model's parent in the registry
+    and as the rows the model was trained on. See set_dataset_state
+    :return: Path to model
+    """
+    model = fit_best_model(data, grid=grid, n_workers=n_workers)
+    if dataset_path:
+        set_dataset_state(model, dataset_path, data["training"]["X"].shape[0] + data["val"]["X"].shape[0])
+    model_path = new_model_path(model_dir)
+    save_model(
+        model,
+        model_path,
+        feature_names=list(data["training"]["X"].columns),
+        parents=[dataset_path] if dataset_path else []
+    )
+    return model_path
+
+
+def main(config: dict = None):
+    if config is None:
+        with open('config.json', 'r') as f:
+            config = json.load(f)
 
     dataset_csv_path = config['output_folder_path']
     model_dir = config['output_model_path']
@@ -108,8 +427,18 @@ def main():
         val_size=val_size,
         create_val_data=True
     )
-    train_model(data, model_dir=model_dir)
+    dataset_path = get_latest_dataset(dataset_csv_path)
+    model_path = train_model(
+        data,
+        model_dir=model_dir,
+        grid=config.get('model_grid'),
+        n_workers=config.get('model_search_workers'),
+        dataset_path=dataset_path
+    )
+    profile = build_profile(load_stats(dataset_path), list(data["training"]["X"].columns) + ["exited"])
+    save_profile(profile, reference_profile_path(model_path), parents=[model_path])
 
 
 if __name__ == '__main__':
+    configure_logging()
     main()
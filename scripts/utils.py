@@ -1,33 +1,126 @@
 import glob
+import json
+import logging
 import os
 import pickle
+import sys
 from typing import Optional
+from typing import TYPE_CHECKING
 
-from sklearn.linear_model import LogisticRegression
+from scripts.fileindex import load_index
+from scripts.fileindex import normalise_path
+from scripts.registry import find_latest
+
+logger = logging.getLogger(__name__)
+
+# Link in the production deployment directory to the release being served
+CURRENT_RELEASE = 'current'
+DEFAULT_LOG_LEVEL = 'INFO'
+
+if TYPE_CHECKING:
+    from sklearn.linear_model import LogisticRegression
+
+
+class StdoutHandler(logging.StreamHandler):
+    """
+    Writes log records to whatever sys.stdout is when they are emitted, so redirecting stdout redirects them too
+    """
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+def configure_logging(level: str = None) -> None:
+    """
+    Writes log messages to stdout, as print did. Messages below level are dropped before they are formatted,
+    so at WARNING the progress messages of stages and the access log of the API cost no I/O.
+    Messages on the paths of requests, such as file lookups, are logged at DEBUG
+
+    :param level: Lowest level written, e.g. DEBUG, INFO or WARNING. Default is log_level in config.json or INFO
+    :return: None
+    """
+    if level is None and os.path.exists('config.json'):
+        with open('config.json', 'r') as f:
+            level = json.load(f).get('log_level')
+    level = (level or DEFAULT_LOG_LEVEL).upper()
+    # The root logger is configured because modules run with python -m log as __main__
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    # werkzeug sets its logger to INFO when it has no level of its own, which would keep writing the access log
+    logging.getLogger('werkzeug').setLevel(level)
+    if not any(isinstance(handler, StdoutHandler) for handler in root_logger.handlers):
+        handler = StdoutHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        root_logger.addHandler(handler)
 
 
 def get_latest_file(path: str, filename: str) -> str:
     """
     Returns the most recent version of a file by sorting files lexicographically.
-    Files should have datetime in their filename
+    Files should have datetime in their filename.
+    Artifacts recorded in the registry of path are looked up there without listing the directory. See scripts.registry
 
     :param path: Directory containing files
     :param filename: Filename f-strings to be passed into glob.glob
     :return: Most lexicographically great file found
     """
+    latest_file = find_latest(path, filename)
+    if latest_file:
+        logger.debug("Latest file in the registry of %s is %s", path, latest_file)
+        return latest_file
+
     latest_file = ''
     filepath = os.path.join(path, filename)
     files = glob.glob(filepath)
     files.sort()
-    print(f"Searching for {filepath}. Found {len(files)} files.")
+    logger.debug("Searching for %s. Found %d files.", filepath, len(files))
 
     if files:
         latest_file = files[-1]
-        print(f"Latest file is {files[-1]}")
+        logger.debug("Latest file is %s", files[-1])
     return latest_file
 
 
-def load_model(model_path: str, is_deployed: bool = False) -> Optional[LogisticRegression]:
+def get_ingestion_index(output_dir: str, input_dir: str) -> dict:
+    """
+    Loads the index of the most recent ingestion record 'ingestedfiles_*.txt' from output_dir.
+    Only files that were ingested from input_dir are returned.
+
+    :param output_dir: Directory containing ingestion records
+    :param input_dir: Directory the recorded files should have been ingested from
+    :return: Index of files already ingested from input_dir. See scripts.fileindex
+    """
+    record = get_latest_file(output_dir, 'ingestedfiles_*.txt')
+    if not record:
+        return {}
+
+    input_dir = normalise_path(input_dir)
+    return {
+        path: fingerprint for path, fingerprint in load_index(record).items()
+        if os.path.dirname(path) == input_dir
+    }
+
+
+def resolve_release(deployment_path: str) -> str:
+    """
+    Release directory the deployment currently points to. Files read from it all belong to the same release
+    even if a new release is promoted meanwhile. See scripts.deployment
+
+    :param deployment_path: Production deployment directory
+    :return: Path to the current release or deployment_path if it has no releases
+    """
+    current = os.path.join(deployment_path, CURRENT_RELEASE)
+    return os.path.realpath(current) if os.path.islink(current) else deployment_path
+
+
+def load_model(model_path: str, is_deployed: bool = False) -> Optional['LogisticRegression']:
     """
     Load model from pkl file in model_path
     :param model_path: Directory containing model pkl file